@@ -26,6 +26,16 @@ from astropy.table import Table
 from lbl.core import base
 from lbl.core import base_classes
 
+# try to import h5py module (only required for hdf5 tables)
+# noinspection PyBroadException
+try:
+    import h5py
+
+    HAS_H5PY = True
+except Exception as _:
+    h5py = None
+    HAS_H5PY = False
+
 # =============================================================================
 # Define variables
 # =============================================================================
@@ -42,6 +52,10 @@ FORBIDDEN_KEYS = ['SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2',
                   'CRVAL2', 'CRPIX2', 'CDELT2', 'BSCALE', 'BZERO',
                   'PHOT_IM', 'FRAC_OBJ', 'FRAC_SKY', 'FRAC_BB',
                   'NEXTEND', '', 'HISTORY', 'XTENSION']
+# file extensions for table formats (default: the format name)
+TABLE_EXTENSIONS = dict(hdf5='h5')
+# the path of the table inside a hdf5 file
+HDF5_TABLE_PATH = 'table'
 
 
 # =============================================================================
@@ -417,31 +431,25 @@ def make_dir(path: str, directory: str, kind: str,
         abspath = Path(path).joinpath(directory)
     else:
         abspath = Path(path).joinpath(directory, subdir)
-    # check if directory exists
-    if abspath.exists():
+    # try to create the directory directly (a single syscall when it already
+    #   exists, rather than a stat followed by a mkdir)
+    try:
+        # with a sub directory we also make path/directory (but not path)
+        if subdir is not None:
+            abspath.parent.mkdir(exist_ok=True)
+        abspath.mkdir()
+    # the directory already exists
+    except FileExistsError:
         if verbose:
             msg = '{0} directory exists (Path={1})'
             margs = [kind, str(abspath)]
             log.general(msg.format(*margs))
-        # return absolute path directory
-        return str(abspath)
-    # else try to create directory
-    else:
-        try:
-            # make directory path
-            if subdir is None:
-                abspath.mkdir()
-            elif abspath.parent.exists():
-                abspath.mkdir()
-            else:
-                abspath.parent.mkdir()
-                abspath.mkdir()
-            # return absolute path directory
-            return str(abspath)
-        except Exception as e:
-            emsg = 'Cannot create {0} directory. Path={1} \n\t{2}: {3}'
-            eargs = [kind, str(abspath), type(e), str(e)]
-            raise LblException(emsg.format(*eargs))
+    except Exception as e:
+        emsg = 'Cannot create {0} directory. Path={1} \n\t{2}: {3}'
+        eargs = [kind, str(abspath), type(e), str(e)]
+        raise LblException(emsg.format(*eargs))
+    # return absolute path directory
+    return str(abspath)
 
 
 def find_files(path_list: List[Path],
@@ -557,19 +565,30 @@ def load_fits(filename: str,
     # deal with no kind
     if kind is None:
         kind = 'fits file'
-    # try to load fits file
+    # try to load fits file - we memory map the file and only copy the
+    #   extension we need, closing the file (and the memory map) straight
+    #   away so handles are not left open until garbage collection
     try:
-        if extnum is not None:
-            data = fits.getdata(filename, ext=extnum)
-        elif extname is not None:
-            data = fits.getdata(filename, extname=extname)
-        else:
-            data = fits.getdata(filename)
+        with fits.open(filename, memmap=True, lazy_load_hdus=True) as hdulist:
+            if extnum is not None:
+                hdu = hdulist[extnum]
+            elif extname is not None:
+                hdu = hdulist[extname]
+            # as fits.getdata - use the first extension if primary is empty
+            elif hdulist[0].data is None:
+                hdu = hdulist[1]
+            else:
+                hdu = hdulist[0]
+            # deal with no data in this extension
+            if hdu.data is None:
+                raise IndexError('No data in extension')
+            # copy the data out of the memory map
+            data = np.array(hdu.data)
     except Exception as e:
         emsg = 'Cannot load {0}. Filename: {1} \n\t{2}: {3}'
         eargs = [kind, filename, type(e), str(e)]
         raise LblException(emsg.format(*eargs))
-    return np.array(data)
+    return data
 
 
 def load_header(filename: str,
@@ -884,6 +903,22 @@ def save_data_to_hdfstore(filename: str, columns: Dict[str, List[np.ndarray]],
 # =============================================================================
 # Define table functions
 # =============================================================================
+def check_table_format(fmt: str):
+    """
+    Check that we can read/write tables of this format (hdf5 tables require
+    the optional h5py module)
+
+    :param fmt: str, the format of the table (i.e. csv, fits or hdf5)
+
+    :raises LblException: if the format is hdf5 and h5py is not installed
+    :return: None
+    """
+    if fmt == 'hdf5' and not HAS_H5PY:
+        emsg = ('Table format hdf5 requires the h5py module (pip install '
+                'h5py) - install it or use the csv or fits format')
+        raise LblException(emsg)
+
+
 def load_table(filename: str, kind: Union[str, None] = None,
                fmt: str = 'fits', get_hdr: bool = False,
                extname: Optional[str] = None,
@@ -893,7 +928,7 @@ def load_table(filename: str, kind: Union[str, None] = None,
 
     :param filename: str, the filename
     :param kind: the kind (for error message)
-    :param fmt: str, the format of the table (i.e. csv or fits)
+    :param fmt: str, the format of the table (i.e. csv, fits or hdf5)
                    defaults to 'fits'
     :param get_hdr: bool, whether to get the header or not
     :param extname: str or None, if set load a specific extension
@@ -903,13 +938,19 @@ def load_table(filename: str, kind: Union[str, None] = None,
     # deal with no kind
     if kind is None:
         kind = '{0} table'.format(format)
+    # check we can deal with this format
+    check_table_format(fmt)
+    # hdf5 tables are stored under a path inside the file
+    kwargs = dict()
+    if fmt == 'hdf5':
+        kwargs['path'] = HDF5_TABLE_PATH
     # try to load fits file
     try:
         with warnings.catch_warnings(record=True) as _:
             if extname is not None:
                 table = Table.read(filename, format=fmt, hdu=extname)
             else:
-                table = Table.read(filename, format=fmt)
+                table = Table.read(filename, format=fmt, **kwargs)
     except Exception as e:
         emsg = 'Cannot load {0}. Filename: {1} \n\t{2}: {3}'
         eargs = [kind, filename, type(e), str(e)]
@@ -938,8 +979,14 @@ def write_table(filename: str, table: Table, fmt: str = 'fits',
 
     :return: None
     """
+    # check we can deal with this format
+    check_table_format(fmt)
+    # hdf5 tables are stored under a path inside the file
+    kwargs = dict()
+    if fmt == 'hdf5':
+        kwargs['path'] = HDF5_TABLE_PATH
     try:
-        table.write(filename, format=fmt, overwrite=overwrite)
+        table.write(filename, format=fmt, overwrite=overwrite, **kwargs)
     except Exception as e:
         emsg = 'Cannot write table {0} to disk \n\t{1}: {2}'
         eargs = [filename, type(e), str(e)]
@@ -17,8 +17,9 @@ import numpy as np
 from astropy import constants
 from scipy import optimize
 from scipy import signal
+from scipy.interpolate import BSpline
 from scipy.interpolate import InterpolatedUnivariateSpline as IUVSpline
-from scipy.special import erf
+from scipy.special import betainc, erf
 
 from lbl.core import base
 from lbl.core import base_classes
@@ -456,6 +457,65 @@ class NanSpline:
         return np.repeat(np.nan, len(x))
 
 
+class StackedSpline:
+    def __init__(self, splines: List[Union[IUVSpline, NanSpline]]):
+        """
+        Evaluate several splines at the same positions in a single call.
+
+        Splines constructed on the same x values (with the same k) share
+        their knots, so we only need to find the knot interval of each
+        position once. If the splines do not share knots (or one is a
+        NanSpline) we fall back to calling each spline in turn.
+
+        Only valid for splines using ext=1 (zero outside the knot interval)
+
+        :param splines: list of InterpolatedUnivariateSpline instances
+        """
+        self.splines = splines
+        self.bspline = None
+        self.xmin, self.xmax = np.nan, np.nan
+        # only stack if all splines are real splines with zeros outside
+        if not all(isinstance(spline, IUVSpline) for spline in splines):
+            return
+        if not all(spline.ext == 1 for spline in splines):
+            return
+        # get the knots and order of the first spline
+        knots, _, k_order = splines[0]._eval_args
+        # all splines must share the knots and order
+        for spline in splines[1:]:
+            if spline._eval_args[2] != k_order:
+                return
+            if not np.array_equal(spline._eval_args[0], knots):
+                return
+        # the number of coefficients (fitpack pads them to the knot length)
+        ncoeffs = len(knots) - k_order - 1
+        # stack the coefficients [ncoeffs, nsplines]
+        coeffs = [spline._eval_args[1][:ncoeffs] for spline in splines]
+        coeffs = np.stack(coeffs, axis=-1)
+        # construct the stacked b-spline
+        self.bspline = BSpline(knots, coeffs, k_order, extrapolate=False)
+        # store the knot interval (outside this we return zeros)
+        self.xmin, self.xmax = knots[k_order], knots[ncoeffs]
+
+    def __call__(self, x: np.ndarray) -> List[np.ndarray]:
+        """
+        Evaluate all splines at positions x
+
+        :param x: np.ndarray, the positions to evaluate the splines at
+
+        :return: list of np.ndarrays, one per spline (same order as given)
+        """
+        # deal with not being able to stack the splines
+        if self.bspline is None:
+            return [spline(x) for spline in self.splines]
+        # evaluate all splines in one go [len(x), nsplines]
+        values = self.bspline(x)
+        # zero outside the knot interval (as ext=1)
+        values[(x < self.xmin) | (x > self.xmax)] = 0.0
+        # return one vector per spline
+        return [values[:, it] for it in range(values.shape[1])]
+
+
 def iuv_spline(x: np.ndarray, y: np.ndarray, **kwargs
                ) -> Union[IUVSpline, NanSpline]:
     """
@@ -533,36 +593,34 @@ def lowpassfilter(input_vect: np.ndarray, width: int = 101,
 
     :return:
     """
-    # indices along input vector
-    index = np.arange(len(input_vect))
-    # placeholders for x and y position along vector
-    xmed = []
-    ymed = []
-    # loop through the lenght of the input vector
-    for it in np.arange(-width // 2, len(input_vect) + width // 2, width // 4):
-        # if we are at the start or end of vector, we go 'off the edge' and
-        # define a box that goes beyond it. It will lead to an effectively
-        # smaller 'width' value, but will provide a consistent result at edges.
-        low_bound = it
-        high_bound = it + int(width)
-        # deal with lower bounds out of bounds --> set to zero
-        if low_bound < 0:
-            low_bound = 0
-        # deal with upper bounds out of bounds --> set to max
-        if high_bound > (len(input_vect) - 1):
-            high_bound = (len(input_vect) - 1)
-        # get the pixel bounds
-        pixval = index[low_bound:high_bound]
-        # do not low pass if not enough points
-        if len(pixval) < 3:
-            continue
-        # if no finite value, skip
-        if np.sum(np.isfinite(input_vect[pixval])) < 3:
-            continue
-        # mean position along vector and NaN median value of
-        # points at those positions
-        xmed.append(nanmean(pixval))
-        ymed.append(nanmedian(input_vect[pixval]))
+    # length of the input vector
+    length = len(input_vect)
+    width = int(width)
+    # the start of each box along the input vector (every 1/4th of width)
+    starts = np.arange(-width // 2, length + width // 2, width // 4)
+    # if we are at the start or end of vector, we go 'off the edge' and
+    # define a box that goes beyond it. It will lead to an effectively
+    # smaller 'width' value, but will provide a consistent result at edges.
+    #   lower bounds out of bounds --> set to zero
+    #   upper bounds out of bounds --> set to max
+    low_bounds = np.maximum(starts, 0)
+    high_bounds = np.minimum(starts + width, length - 1)
+    # pad the input vector with NaNs (everything outside [0, length - 1) is
+    #   NaN) so that every box is a fixed width window
+    offset = -starts[0]
+    padded = np.full(offset + starts[-1] + width + 1, np.nan)
+    padded[offset:offset + length - 1] = input_vect[:length - 1]
+    # all boxes as a 2D [n_boxes, width] view (no copy)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width)
+    windows = windows[starts + offset]
+    # do not low pass if not enough points and if less than 3 finite values
+    #   skip this box
+    valid = np.sum(np.isfinite(windows), axis=1) >= 3
+    valid &= (high_bounds - low_bounds) >= 3
+    # mean position along vector and NaN median value of points at those
+    # positions (all boxes in one call)
+    xmed = (low_bounds[valid] + high_bounds[valid] - 1) / 2.0
+    ymed = nanmedian(windows[valid], axis=1)
     # convert to arrays
     xmed = np.array(xmed, dtype=float)
     ymed = np.array(ymed, dtype=float)
@@ -585,12 +643,16 @@ def lowpassfilter(input_vect: np.ndarray, width: int = 101,
     return lowpass
 
 
-def doppler_shift(wavegrid: np.ndarray, velocity: float) -> np.ndarray:
+def doppler_shift(wavegrid: np.ndarray, velocity: float,
+                  out: Optional[np.ndarray] = None) -> np.ndarray:
     """
     Apply a doppler shift
 
     :param wavegrid: wave grid to shift
     :param velocity: float, velocity expressed in m/s
+    :param out: np.ndarray or None, if set the shifted wave grid is written
+                into this array (same shape as wavegrid) instead of a new
+                array
 
     :return: np.ndarray, the updated wave grid
     """
@@ -599,7 +661,7 @@ def doppler_shift(wavegrid: np.ndarray, velocity: float) -> np.ndarray:
     # relativistic calculation (1 + v/c)
     part2 = 1 + (velocity / speed_of_light_ms)
     # return updated wave grid
-    return wavegrid * np.sqrt(part1 / part2)
+    return np.multiply(wavegrid, np.sqrt(part1 / part2), out=out)
 
 
 def gauss_function(x: Union[float, np.ndarray], a: float, x0: float,
@@ -639,6 +701,36 @@ def gauss_fit_s(x: Union[float, np.ndarray], x0: float, sigma: float,
     return gauss + correction
 
 
+def gauss_fit_s_jac(x: np.ndarray, x0: float, sigma: float, a: float,
+                    zp: float, slope: float) -> np.ndarray:
+    """
+    Analytic jacobian of gauss_fit_s (for curve_fit jac=)
+
+    :param x: numpy array (1D), the x values for the gauss fit
+    :param x0: float, the mean position
+    :param sigma: float, the FWHM
+    :param a: float, the amplitude
+    :param zp: float, the dc level
+    :param slope: float, the float (x-x0) * slope
+
+    :return: np.ndarray - the partial derivatives [len(x), 5] with respect to
+             x0, sigma, a, zp and slope
+    """
+    # offset from the mean
+    dx = x - x0
+    # the gaussian (without amplitude)
+    gauss = np.exp(-0.5 * dx ** 2 / (sigma ** 2))
+    # storage for the jacobian
+    jac = np.empty((len(x), 5))
+    # d/dx0, d/dsigma, d/da, d/dzp, d/dslope
+    jac[:, 0] = a * gauss * dx / sigma ** 2 - slope
+    jac[:, 1] = a * gauss * dx ** 2 / sigma ** 3
+    jac[:, 2] = gauss
+    jac[:, 3] = 1.0
+    jac[:, 4] = dx
+    return jac
+
+
 def gauss_fit_e(x: Union[float, np.ndarray], x0: float, fwhm: float,
                 amp: float, ears: float, expo: float) -> Union[float, np.ndarray]:
     """
@@ -709,6 +801,46 @@ def estimate_sigma(tmp: np.ndarray, sigma=1.0) -> float:
     return (upper - lower) / 2.0
 
 
+def pearsonr(x: np.ndarray, y: np.ndarray) -> Tuple[float, float]:
+    """
+    Pearson correlation coefficient and the two-sided p-value for testing
+    non-correlation (same as scipy.stats.pearsonr but without the scipy
+    wrapping overhead - this is called once per line in the compil)
+
+    :param x: np.ndarray (1D), the first input (no NaNs, len >= 2)
+    :param y: np.ndarray (1D), the second input (no NaNs, same length as x)
+
+    :return: tuple, 1. the correlation coefficient, 2. the p-value
+    """
+    # get the number of points
+    npoints = len(x)
+    # deal with too few points (as scipy.stats.pearsonr)
+    if npoints < 2:
+        emsg = 'pearsonr: x and y must have length at least 2 (len = {0})'
+        raise base_classes.LblException(emsg.format(npoints))
+    # two points are always perfectly (anti-)correlated and the p-value is 1
+    #   (as scipy.stats.pearsonr) unless an input is constant (undefined)
+    if npoints == 2:
+        rvalue = np.sign(x[1] - x[0]) * np.sign(y[1] - y[0])
+        if rvalue == 0:
+            return np.nan, np.nan
+        return float(rvalue), 1.0
+    # remove the mean of both vectors
+    xm = x - np.mean(x)
+    ym = y - np.mean(y)
+    # the correlation coefficient (normalize first to avoid overflow)
+    with warnings.catch_warnings(record=True) as _:
+        xm = xm / np.sqrt(np.dot(xm, xm))
+        ym = ym / np.sqrt(np.dot(ym, ym))
+        rvalue = np.clip(np.dot(xm, ym), -1.0, 1.0)
+    # under the null hypothesis r follows a beta distribution on [-1, 1]
+    #   with a = b = n/2 - 1 (symmetric so we can use the lower tail)
+    ab = npoints / 2 - 1
+    pvalue = 2 * betainc(ab, ab, 0.5 * (1 - np.abs(rvalue)))
+    # return the correlation and p-value
+    return float(rvalue), float(pvalue)
+
+
 def curve_fit(*args, funcname: Union[str, None] = None, **kwargs):
     """
     Wrapper around curve_fit to catch a curve_fit error
@@ -140,6 +140,30 @@ params.set(key='TOTAL', value=-1, source=__NAME__, dtype=int,
                 '-1 means no multiprocessing',
            arg='--total')
 
+# Define the number of worker processes to use (for multiprocessing)
+#     in compute each worker runs one iteration (of TOTAL=NUM_WORKERS)
+#     in compil the workers read the lbl rv files
+#     1 means no multiprocessing
+params.set(key='NUM_WORKERS', value=1, source=__NAME__, dtype=int,
+           desc='the number of worker processes to use (for '
+                'multiprocessing). In compute each worker runs one '
+                'iteration (of TOTAL=NUM_WORKERS), in compil the workers '
+                'read the lbl rv files. 1 means no multiprocessing',
+           arg='--num_workers')
+
+# Define the number of science files to read ahead of time (in a background
+#     thread) while the current file is being processed
+#     each file read ahead is held in memory (a full science frame and its
+#     header) for every worker, i.e. up to NUM_WORKERS x (1 + PREFETCH_FILES)
+#     science frames in memory at once
+#     0 means no reading ahead
+params.set(key='PREFETCH_FILES', value=1, source=__NAME__, dtype=int,
+           desc='the number of science files to read ahead of time (in a '
+                'background thread) while the current file is being '
+                'processed. Each file read ahead holds an extra science frame '
+                'in memory (per worker). 0 means no reading ahead',
+           arg='--prefetch_files')
+
 # =============================================================================
 # Define common parameters (between compute / compil)
 # =============================================================================
@@ -200,7 +224,8 @@ params.set(key='MASK_FILE', value='None', source=__NAME__,
 
 # Define ref table format
 params.set(key='REF_TABLE_FMT', value='csv', source=__NAME__,
-           desc='Ref table format (i.e. csv)')
+           desc='Ref table format (i.e. csv, fits or hdf5 [requires h5py, '
+                'pip install lbl[hdf5]])')
 
 # define the High pass width [km/s]
 params.set(key='HP_WIDTH', value=None, source=__NAME__,
@@ -184,8 +184,11 @@ class Instrument:
         self._set_object_template()
         # set object name
         mask_name = os.path.basename(mask_file).replace('.fits', '')
+        # the extension depends on the ref table format
+        table_fmt = self.params['REF_TABLE_FMT']
+        ext = io.TABLE_EXTENSIONS.get(table_fmt, table_fmt)
         # set base name
-        basename = 'ref_table_{0}.csv'.format(mask_name)
+        basename = 'ref_table_{0}.{1}'.format(mask_name, ext)
         # get absolute path
         abspath = os.path.join(directory, basename)
         # check that this file exists
@@ -44,6 +44,8 @@ ARGS_COMPIL = [  # core
     'PLOT', 'PLOT_COMPIL_CUMUL', 'PLOT_COMPIL_BINNED',
     # other
     'SKIP_DONE', 'RDB_SUFFIX', 'VERBOSE', 'PROGRAM',
+    # multiprocessing arguments
+    'NUM_WORKERS',
 ]
 
 DESCRIPTION_COMPIL = 'Use this code to compile the LBL rdb files'
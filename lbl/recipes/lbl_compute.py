@@ -9,6 +9,9 @@ Created on 2021-03-15
 
 @author: cook
 """
+import multiprocessing
+from typing import Any, Dict
+
 import numpy as np
 
 from lbl.core import base
@@ -47,7 +50,7 @@ ARGS_COMPUTE = [  # core
     # other
     'SKIP_DONE', 'VERBOSE', 'PROGRAM', 'MASK_FILE',
     # multiprocessing arguments
-    'ITERATION', 'TOTAL',
+    'ITERATION', 'TOTAL', 'NUM_WORKERS', 'PREFETCH_FILES',
 ]
 
 DESCRIPTION_COMPUTE = 'Use this code to compute the LBL rv'
@@ -76,9 +79,15 @@ def main(**kwargs):
     # print splash
     lbl_misc.splash(name=__STRNAME__, instrument=inst.name,
                     params=args, plogger=log)
+    # get the number of workers
+    num_workers = inst.params['NUM_WORKERS']
     # run __main__
     try:
-        namespace = __main__(inst)
+        # deal with splitting the science files over several processes
+        if num_workers > 1 and inst.params['ITERATION'] < 0:
+            namespace = run_workers(kwargs, num_workers)
+        else:
+            namespace = __main__(inst)
     except LblException as e:
         raise LblException(e.message, verbose=False)
     except Exception as e:
@@ -91,6 +100,60 @@ def main(**kwargs):
     return namespace
 
 
+def compute_worker(kwargs: Dict[str, Any]):
+    """
+    Run a single worker of the compute recipe (must be defined at the top
+    level of the module so that multiprocessing can pickle it)
+
+    :param kwargs: kwargs to parse to main (must contain ITERATION and TOTAL)
+
+    :return: None - the namespace is not passed back to the parent process
+    """
+    # run main (ITERATION and TOTAL select the science files for this worker)
+    _ = main(**kwargs)
+
+
+def run_workers(kwargs: Dict[str, Any], num_workers: int) -> Dict[str, Any]:
+    """
+    Run the compute recipe over a pool of "num_workers" processes. Each
+    worker runs one iteration (ITERATION=0...NUM_WORKERS-1, TOTAL=NUM_WORKERS)
+    and processes every NUM_WORKERS-th science file. We cannot use a single
+    science file as the task unit because each file uses the systemic and
+    model velocity of the previous file as a starting point.
+
+    :param kwargs: kwargs passed to main
+    :param num_workers: int, the number of worker processes
+
+    :return: all variables in local namespace
+    """
+    # remove any multiprocessing arguments from the kwargs
+    worker_kwargs = dict()
+    for kwarg in kwargs:
+        if kwarg.upper() not in ['ITERATION', 'TOTAL', 'NUM_WORKERS']:
+            worker_kwargs[kwarg] = kwargs[kwarg]
+    # construct the kwargs for each worker
+    all_kwargs = []
+    for iteration in range(num_workers):
+        ikwargs = dict(worker_kwargs)
+        ikwargs['ITERATION'] = iteration
+        ikwargs['TOTAL'] = num_workers
+        ikwargs['NUM_WORKERS'] = 1
+        all_kwargs.append(ikwargs)
+    # log that we are using multiple workers
+    msg = 'Running compute over {0} worker processes'
+    log.general(msg.format(num_workers))
+    # run the workers (iteration 0 creates the ref table, the others wait)
+    with multiprocessing.Pool(num_workers) as pool:
+        pool.map(compute_worker, all_kwargs, chunksize=1)
+    # -------------------------------------------------------------------------
+    # return local namespace
+    # -------------------------------------------------------------------------
+    # do not remove this line
+    logmsg = log.get_cache()
+    # return
+    return locals()
+
+
 def __main__(inst: InstrumentsType, **kwargs):
     """
     The main recipe function - all code dealing with recipe functionality
@@ -190,140 +253,154 @@ def __main__(inst: InstrumentsType, **kwargs):
     mean_time, std_time, time_left = np.nan, np.nan, ''
     all_durations = []
     count = 0
-    # loop through each science file
-    for it, science_file in enumerate(science_files):
-        # ---------------------------------------------------------------------
-        # 6.1 log process
-        # ---------------------------------------------------------------------
-        # number left
-        nleft = len(science_files) - (it + 1)
-        # standard loop message
-        log.info('*' * 79)
-        msg = 'Processing file {0} / {1}   ({2} left)'
-        margs = [it + 1, len(science_files), nleft]
-        log.info(msg.format(*margs))
-        log.info('*' * 79)
-        # add which science file is being processed
-        msg = '\t Science file = {0}'
-        log.general(msg.format(science_file))
-        # add time stats
-        if count > 3:
-            msgs = ['\tDuration per file {0:.2f}+-{1:.2f} s']
-            msgs += ['\tTime left to completion: {2}']
-            margs = [mean_time, std_time, time_left]
-            for msg in msgs:
-                log.general(msg.format(*margs))
-        # ---------------------------------------------------------------------
-        # 6.2 get lbl rv file and check whether it exists
-        # ---------------------------------------------------------------------
-        lblrv_file, lblrv_exists = inst.get_lblrv_file(science_file, lblrv_dir)
-        # If output file exists then get the model velocity from here
-        if lblrv_exists and not np.isfinite(model_velocity):
-            lblrv_hdr = inst.load_header(lblrv_file, kind='lblrv fits file')
-            model_velocity = lblrv_hdr.get_hkey(inst.params['KW_MODELVEL'],
-                                                dtype=float)
-            largs = [model_velocity]
-            log.general('We read model velo = {0:.2f} m/s'.format(*largs))
-        # if file exists and we are skipping done files
-        if lblrv_exists and inst.params['SKIP_DONE']:
-            # log message about skipping
-            log.general('\t\tFile exists and skipping activated. '
-                        'Skipping file.')
-            # skip
-            continue
-        # ---------------------------------------------------------------------
-        # 6.3 load science file
-        # ---------------------------------------------------------------------
-        sci_data, sci_hdr = inst.load_science_file(science_file)
-        # flag calibration file
-        if inst.params['DATA_TYPE'] != 'SCIENCE':
-            model_velocity = 0
-
-        # ---------------------------------------------------------------------
-        # 6.4 load blaze if not set above
-        # ---------------------------------------------------------------------
-        if blaze is None:
-            blaze, _ = inst.load_blaze_from_science(science_file, sci_data,
-                                                    sci_hdr, calib_dir)
-        # ---------------------------------------------------------------------
-        # 6.5 check for bad files (via a header key)
-        # ---------------------------------------------------------------------
-        # check we have a bad hdr key
-        if bad_hdr_key is not None and bad_hdr_key in sci_hdr:
-            # get bad header key
-            sci_bad_hdr_key = sci_hdr.get_hkey(bad_hdr_key)
-            # if sci_bad_hdr_key in bad_hdr_keys
-            if str(sci_bad_hdr_key) in bad_hdr_keys:
-                # log message about bad header key
-                log.general('\t\tFile is known to be bad. Skipping file.')
-                # skip
-                continue
-        # ---------------------------------------------------------------------
-        # 6.6 quality control on snr
-        # ---------------------------------------------------------------------
-        # get snr key
-        snr_key = inst.params['KW_SNR']
-        snr_limit = inst.params['SNR_THRESHOLD']
-        # check we have snr key in science header
-        if snr_key in sci_hdr:
-            # get snr value
-            snr_value = sci_hdr.get_hkey(snr_key, dtype=float)
-            # check if value is less than limit
-            if snr_value < snr_limit:
-                # log message
-                msg = '\t\tSNR < {0} (SNR = {1}). Skipping file.'
-                margs = [snr_limit, snr_value]
-                log.general(msg.format(*margs))
+    # work out which science files will be loaded (files that are done are
+    #   not loaded if we are skipping done files)
+    load_files = []
+    for science_file in science_files:
+        _, lblrv_exists = inst.get_lblrv_file(science_file, lblrv_dir)
+        if not (lblrv_exists and inst.params['SKIP_DONE']):
+            load_files.append(science_file)
+    # read science files ahead of time (overlaps reading with compute rv),
+    #   the background reads are stopped however the loop exits
+    num_prefetch = inst.params['PREFETCH_FILES']
+    with general.ScienceFilePrefetch(inst, load_files,
+                                     num_prefetch) as prefetch:
+        # loop through each science file
+        for it, science_file in enumerate(science_files):
+            # -----------------------------------------------------------------
+            # 6.1 log process
+            # -----------------------------------------------------------------
+            # number left
+            nleft = len(science_files) - (it + 1)
+            # standard loop message
+            log.info('*' * 79)
+            msg = 'Processing file {0} / {1}   ({2} left)'
+            margs = [it + 1, len(science_files), nleft]
+            log.info(msg.format(*margs))
+            log.info('*' * 79)
+            # add which science file is being processed
+            msg = '\t Science file = {0}'
+            log.general(msg.format(science_file))
+            # add time stats
+            if count > 3:
+                msgs = ['\tDuration per file {0:.2f}+-{1:.2f} s']
+                msgs += ['\tTime left to completion: {2}']
+                margs = [mean_time, std_time, time_left]
+                for msg in msgs:
+                    log.general(msg.format(*margs))
+            # -----------------------------------------------------------------
+            # 6.2 get lbl rv file and check whether it exists
+            # -----------------------------------------------------------------
+            lblrv_file, lblrv_exists = inst.get_lblrv_file(science_file,
+                                                           lblrv_dir)
+            # If output file exists then get the model velocity from here
+            if lblrv_exists and not np.isfinite(model_velocity):
+                lblrv_hdr = inst.load_header(lblrv_file,
+                                             kind='lblrv fits file')
+                model_velocity = lblrv_hdr.get_hkey(inst.params['KW_MODELVEL'],
+                                                    dtype=float)
+                largs = [model_velocity]
+                log.general('We read model velo = {0:.2f} m/s'.format(*largs))
+            # if file exists and we are skipping done files
+            if lblrv_exists and inst.params['SKIP_DONE']:
+                # log message about skipping
+                log.general('\t\tFile exists and skipping activated. '
+                            'Skipping file.')
                 # skip
                 continue
-            else:
-                # log message
-                msg = '\t\tSNR > {0} (SNR = {1:.4f}), passed SNR criteria'
-                margs = [snr_limit, snr_value]
-                log.general(msg.format(*margs))
+            # -----------------------------------------------------------------
+            # 6.3 load science file
+            # -----------------------------------------------------------------
+            sci_data, sci_hdr = prefetch.load(science_file)
+            # flag calibration file
+            if inst.params['DATA_TYPE'] != 'SCIENCE':
+                model_velocity = 0
+
+            # -----------------------------------------------------------------
+            # 6.4 load blaze if not set above
+            # -----------------------------------------------------------------
+            if blaze is None:
+                blaze, _ = inst.load_blaze_from_science(science_file, sci_data,
+                                                        sci_hdr, calib_dir)
+            # -----------------------------------------------------------------
+            # 6.5 check for bad files (via a header key)
+            # -----------------------------------------------------------------
+            # check we have a bad hdr key
+            if bad_hdr_key is not None and bad_hdr_key in sci_hdr:
+                # get bad header key
+                sci_bad_hdr_key = sci_hdr.get_hkey(bad_hdr_key)
+                # if sci_bad_hdr_key in bad_hdr_keys
+                if str(sci_bad_hdr_key) in bad_hdr_keys:
+                    # log message about bad header key
+                    log.general('\t\tFile is known to be bad. Skipping file.')
+                    # skip
+                    continue
+            # -----------------------------------------------------------------
+            # 6.6 quality control on snr
+            # -----------------------------------------------------------------
+            # get snr key
+            snr_key = inst.params['KW_SNR']
+            snr_limit = inst.params['SNR_THRESHOLD']
+            # check we have snr key in science header
+            if snr_key in sci_hdr:
+                # get snr value
+                snr_value = sci_hdr.get_hkey(snr_key, dtype=float)
+                # check if value is less than limit
+                if snr_value < snr_limit:
+                    # log message
+                    msg = '\t\tSNR < {0} (SNR = {1}). Skipping file.'
+                    margs = [snr_limit, snr_value]
+                    log.general(msg.format(*margs))
+                    # skip
+                    continue
+                else:
+                    # log message
+                    msg = '\t\tSNR > {0} (SNR = {1:.4f}), passed SNR criteria'
+                    margs = [snr_limit, snr_value]
+                    log.general(msg.format(*margs))
 
-        # ---------------------------------------------------------------------
-        # 6.7 compute rv
-        # ---------------------------------------------------------------------
-        try:
-            cout = general.compute_rv(inst, it, sci_data, sci_hdr,
-                                      splines=splines,
-                                      ref_table=ref_table, blaze=blaze,
-                                      systemic_props=systemic_vel_props,
-                                      systemic_all=systemic_all,
-                                      mjdate_all=mjdate_all,
-                                      ccf_ewidth=ccf_ewidth,
-                                      reset_rv=reset_rv,
-                                      model_velocity=model_velocity,
-                                      science_file=science_file,
-                                      mask_file=mask_file)
-        except LblLowCCFSNR as e:
-            emsg = e.message + '\n Skipping file.'
-            log.warning(emsg)
-            continue
-        # get back ref_table and outputs
-        ref_table, outputs = cout
-        # ---------------------------------------------------------------------
-        # update iterables (for next iteration)
-        systemic_all = outputs['SYSTEMIC_ALL']
-        mjdate_all = outputs['MJDATE_ALL']
-        reset_rv = outputs['RESET_RV']
-        ccf_ewidth = outputs['CCF_EW']
-        model_velocity = outputs['MODEL_VELOCITY']
+            # -----------------------------------------------------------------
+            # 6.7 compute rv
+            # -----------------------------------------------------------------
+            try:
+                cout = general.compute_rv(inst, it, sci_data, sci_hdr,
+                                          splines=splines,
+                                          ref_table=ref_table, blaze=blaze,
+                                          systemic_props=systemic_vel_props,
+                                          systemic_all=systemic_all,
+                                          mjdate_all=mjdate_all,
+                                          ccf_ewidth=ccf_ewidth,
+                                          reset_rv=reset_rv,
+                                          model_velocity=model_velocity,
+                                          science_file=science_file,
+                                          mask_file=mask_file)
+            except LblLowCCFSNR as e:
+                emsg = e.message + '\n Skipping file.'
+                log.warning(emsg)
+                continue
+            # get back ref_table and outputs
+            ref_table, outputs = cout
+            # -----------------------------------------------------------------
+            # update iterables (for next iteration)
+            systemic_all = outputs['SYSTEMIC_ALL']
+            mjdate_all = outputs['MJDATE_ALL']
+            reset_rv = outputs['RESET_RV']
+            ccf_ewidth = outputs['CCF_EW']
+            model_velocity = outputs['MODEL_VELOCITY']
 
-        all_durations.append(outputs['TOTAL_DURATION'])
-        # ---------------------------------------------------------------------
-        # 6.8 save to file
-        # ---------------------------------------------------------------------
-        inst.write_lblrv_table(ref_table, lblrv_file, sci_hdr, outputs)
-        # ---------------------------------------------------------------------
-        # 6.9 Time taken stats (For next iteration)
-        # ---------------------------------------------------------------------
-        if count > 2:
-            # smart timing
-            sout = general.smart_timing(all_durations, nleft)
-            mean_time, std_time, time_left = sout
-        count += 1
+            all_durations.append(outputs['TOTAL_DURATION'])
+            # -----------------------------------------------------------------
+            # 6.8 save to file
+            # -----------------------------------------------------------------
+            inst.write_lblrv_table(ref_table, lblrv_file, sci_hdr, outputs)
+            # -----------------------------------------------------------------
+            # 6.9 Time taken stats (For next iteration)
+            # -----------------------------------------------------------------
+            if count > 2:
+                # smart timing
+                sout = general.smart_timing(all_durations, nleft)
+                mean_time, std_time, time_left = sout
+            count += 1
     # -------------------------------------------------------------------------
     # return local namespace
     # -------------------------------------------------------------------------
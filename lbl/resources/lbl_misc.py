@@ -9,8 +9,10 @@ Created on 2021-03-23
 
 @author: cook
 """
+import functools
 import os
 import shutil
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any, Dict, Union
 
@@ -28,36 +30,40 @@ __date__ = base.__date__
 __authors__ = base.__authors__
 # get classes
 log = base_classes.log
+# path to the data structure read me (copied to the data directory)
+README_PATH = Path(__file__).parent.joinpath('data_str_readme.md')
 
 
 # =============================================================================
 # Define functions
 # =============================================================================
+@functools.lru_cache(maxsize=None)
 def copy_readme(data_dir: str):
     """
     Copies the data structure read me to here
 
+    Only done once per data directory per process (every recipe calls this
+    via make_all_directories)
+
     :param data_dir: str, the data directory
 
     :return:
     """
-    # get the path to this directory
-    python_filename = __file__
-    # get in directory
-    inpath = Path(python_filename).parent
     # get out directory
     outpath = Path(data_dir)
     # check / make the outpath
     io.make_dir(str(outpath), '', 'Data', verbose=False)
-    # construct path to read me
-    input_path = inpath.joinpath('data_str_readme.md')
     # construct new path to read me
     output_path = outpath.joinpath('README.md')
-    # check for output path
-    if output_path.exists():
+    # copy the file (contents only - no need to copy permissions) - opening
+    #   in exclusive mode means we do not need a separate exists check
+    try:
+        with open(output_path, 'xb') as outfile:
+            with open(README_PATH, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile)
+    # if the read me is already there we do not copy it again
+    except FileExistsError:
         return
-    # else copy the file
-    shutil.copy(str(input_path), str(output_path))
 
 
 def move_log(data_dir: str, recipe: str):
@@ -71,9 +77,9 @@ def move_log(data_dir: str, recipe: str):
     global log
     # check that log dir exists
     log_path = io.make_dir(data_dir, 'log', 'log')
-    # make log file
-    timenow = base.Time.now().fits
-    datenow = str(timenow).split('T')[0]
+    # make log file (UTC date as YYYY-MM-DD, same as astropy Time.now() but
+    #   without the cost of constructing an astropy Time)
+    datenow = datetime.now(timezone.utc).date().isoformat()
     # clean recipe name
     recipe = recipe.replace('.py', '').replace(' ', '_')
     # construct log file name
@@ -100,26 +106,25 @@ def splash(name: str, instrument: str, params: base_classes.ParamDict,
     msgs += ['*' * 79]
     msgs += ['']
     margs = [name, __version__, instrument]
-    # loop through messages
-    for msg in msgs:
-        plogger.info(msg.format(*margs))
+    # log all messages in a single call
+    plogger.info('\n'.join(msgs).format(*margs))
 
     # add user args
     if params is not None:
         if 'USER_KWARGS' in params:
             if len(params['USER_KWARGS']) > 0:
-                plogger.info('User keyword arguments:')
-                # loop around arguments and add
-                for cmdmsg in params['USER_KWARGS']:
-                    plogger.info(cmdmsg)
+                # add all arguments in a single call
+                umsgs = ['User keyword arguments:']
+                umsgs += list(params['USER_KWARGS'])
+                plogger.info('\n'.join(umsgs))
 
     # add command line arguments (if not None)
     if params is not None:
         if len(params['COMMAND_LINE_ARGS']) > 0:
-            plogger.info('Command line arguments:')
-            # loop around arguments and add
-            for cmdmsg in params['COMMAND_LINE_ARGS']:
-                plogger.info(cmdmsg)
+            # add all arguments in a single call
+            cmsgs = ['Command line arguments:']
+            cmsgs += list(params['COMMAND_LINE_ARGS'])
+            plogger.info('\n'.join(cmsgs))
 
 
 def end(recipe: str, plogger: Union[logger.Log, None] = None):
@@ -141,9 +146,8 @@ def end(recipe: str, plogger: Union[logger.Log, None] = None):
     msgs += ['*' * 79]
     msgs += ['']
     margs = [recipe]
-    # loop through messages
-    for msg in msgs:
-        plogger.info(msg.format(*margs))
+    # log all messages in a single call
+    plogger.info('\n'.join(msgs).format(*margs))
     return
 
 
@@ -7,18 +7,20 @@ Created on 2021-03-16
 
 @author: cook
 """
+import contextlib
+import multiprocessing
 import os
 import time
 import warnings
-from typing import Any, Dict, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import wget
 from astropy import constants
 from astropy import units as uu
 from astropy.table import Table
-from scipy import stats
-from scipy.stats import pearsonr
+from scipy.special import gammaincc
 
 from lbl.core import astro
 from lbl.core import base
@@ -136,6 +138,110 @@ def filter_science_files(inst: InstrumentsType,
     return science_files[iteration::total]
 
 
+class ScienceFilePrefetch:
+    def __init__(self, inst: InstrumentsType, science_files: List[str],
+                 num_prefetch: int):
+        """
+        Read science files ahead of time in a background thread, so that
+        reading the next file overlaps with computing the rv of the current
+        file. Files must be requested (via load) in the order given.
+
+        Only one background thread is used: some instruments read their
+        science files via HDF5 which should not be read from several threads
+        at once.
+
+        :param inst: Instrument instance
+        :param science_files: list of strings, the science files that will
+                              be loaded (in the order they will be loaded)
+        :param num_prefetch: int, the number of files to read ahead of time
+                             (0 means files are read when requested)
+        """
+        self.inst = inst
+        self.science_files = list(science_files)
+        self.num_prefetch = num_prefetch
+        # the position of the next science file to read
+        self.position = 0
+        # storage for files being read (key = science filename)
+        self.futures = dict()
+        # only start a thread if we are reading ahead
+        if num_prefetch > 0:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            # start reading the first files
+            for _ in range(num_prefetch):
+                self._submit_next()
+        else:
+            self.executor = None
+
+    def _submit_next(self):
+        """
+        Start reading the next science file in the background thread
+
+        :return: None
+        """
+        # deal with having no more files to read
+        if self.position >= len(self.science_files):
+            return
+        # get the next file
+        science_file = self.science_files[self.position]
+        # submit the read to the thread
+        future = self.executor.submit(self.inst.load_science_file,
+                                      science_file)
+        self.futures[science_file] = future
+        # move on to the next file
+        self.position += 1
+
+    def load(self, science_file: str) -> Tuple[np.ndarray, io.LBLHeader]:
+        """
+        Get the science data and header for a science file (read in the
+        background thread if it was prefetched, otherwise read it now)
+
+        :param science_file: str, absolute path to the science file
+
+        :return: tuple, data (np.ndarray) and header (io.LBLHeader)
+        """
+        # if we have not prefetched this file read it now
+        if science_file not in self.futures:
+            return self.inst.load_science_file(science_file)
+        # get the read of this file
+        future = self.futures.pop(science_file)
+        # start reading the next file
+        self._submit_next()
+        # wait for this file (re-raises any exception from reading)
+        return future.result()
+
+    def close(self):
+        """
+        Stop reading any remaining files and shut down the background thread
+
+        :return: None
+        """
+        if self.executor is None:
+            return
+        # cancel any reads that have not started
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = dict()
+        # shut down the thread
+        self.executor.shutdown(wait=True)
+        self.executor = None
+
+    def __enter__(self) -> 'ScienceFilePrefetch':
+        """
+        Use the prefetch as a context manager (closed on exit)
+
+        :return: the prefetch instance
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Close the prefetch on leaving the context (even on an exception)
+
+        :return: None (exceptions are not suppressed)
+        """
+        self.close()
+
+
 def make_ref_dict(inst: InstrumentsType, reftable_file: str,
                   reftable_exists: bool, science_files: List[str],
                   mask_file: str, calib_dir: str) -> Dict[str, np.ndarray]:
@@ -166,32 +272,37 @@ def make_ref_dict(inst: InstrumentsType, reftable_file: str,
         # log writing
         log.general('Reading existing ref table {0}'.format(reftable_file))
         # load ref table from disk
-        table = Table.read(reftable_file, format=params['REF_TABLE_FMT'])
-        # copy columns
-        ref_dict['ORDER'] = np.array(table['ORDER'])
-        ref_dict['WAVE_START'] = np.array(table['WAVE_START'])
-        ref_dict['WAVE_END'] = np.array(table['WAVE_END'])
-        ref_dict['WEIGHT_LINE'] = np.array(table['WEIGHT_LINE'])
-        ref_dict['XPIX'] = np.array(table['XPIX'])
-        ref_dict['LINE_SNR'] = np.array(table['LINE_SNR'])
-        ref_dict['LINE_DEPTH'] = np.array(table['LINE_DEPTH'])
-        ref_dict['LOCAL_FLUX'] = np.array(table['LOCAL_FLUX'])
+        table = io.load_table(reftable_file, kind='ref table',
+                              fmt=params['REF_TABLE_FMT'])
+        # get columns as native byte order arrays (tables read from fits are
+        #   big-endian, which the compiled functions of compute_rv cannot
+        #   take) - native columns (e.g. csv) are used without a copy
+        ref_dict['ORDER'] = np.asarray(table['ORDER'], dtype=int)
+        ref_dict['WAVE_START'] = np.asarray(table['WAVE_START'], dtype=float)
+        ref_dict['WAVE_END'] = np.asarray(table['WAVE_END'], dtype=float)
+        ref_dict['WEIGHT_LINE'] = np.asarray(table['WEIGHT_LINE'], dtype=float)
+        ref_dict['XPIX'] = np.asarray(table['XPIX'], dtype=float)
+        ref_dict['LINE_SNR'] = np.asarray(table['LINE_SNR'], dtype=float)
+        ref_dict['LINE_DEPTH'] = np.asarray(table['LINE_DEPTH'], dtype=float)
+        ref_dict['LOCAL_FLUX'] = np.asarray(table['LOCAL_FLUX'], dtype=float)
         # ratio of expected VS actual RMS in difference of model vs line
-        ref_dict['RMSRATIO'] = np.array(table['RMSRATIO'])
+        ref_dict['RMSRATIO'] = np.asarray(table['RMSRATIO'], dtype=float)
         # effective number of pixels in line
-        ref_dict['NPIXLINE'] = np.array(table['NPIXLINE'])
+        ref_dict['NPIXLINE'] = np.asarray(table['NPIXLINE'], dtype=int)
         # mean line position in pixel space
-        ref_dict['MEANXPIX'] = np.array(table['MEANXPIX'])
+        ref_dict['MEANXPIX'] = np.asarray(table['MEANXPIX'], dtype=float)
         # blaze value compared to peak for that order
-        ref_dict['MEANBLAZE'] = np.array(table['MEANBLAZE'])
+        ref_dict['MEANBLAZE'] = np.asarray(table['MEANBLAZE'], dtype=float)
         # amp continuum
-        ref_dict['AMP_CONTINUUM'] = np.array(table['AMP_CONTINUUM'])
+        ref_dict['AMP_CONTINUUM'] = np.asarray(table['AMP_CONTINUUM'],
+                                               dtype=float)
         # Considering the number of pixels, expected and actual RMS,
         #     this is the likelihood that the line is acually valid from a
         #     Chi2 test point of view
-        ref_dict['CHI2'] = np.array(table['CHI2'])
+        ref_dict['CHI2'] = np.asarray(table['CHI2'], dtype=float)
         # probability of valid considering the chi2 CDF for the number of DOF
-        ref_dict['CHI2_VALID_CDF'] = np.array(table['CHI2_VALID_CDF'])
+        ref_dict['CHI2_VALID_CDF'] = np.asarray(table['CHI2_VALID_CDF'],
+                                                dtype=float)
         # close table
         del table
     # -------------------------------------------------------------------------
@@ -199,53 +310,78 @@ def make_ref_dict(inst: InstrumentsType, reftable_file: str,
     else:
         # load wave solution from first science file
         wavegrid = inst.get_sample_wave_grid(calib_dir, science_files[0])
-        # storage for vectors
-        order, wave_start, wave_end, weight_line, xpix = [], [], [], [], []
-        line_snr, line_depth, local_flux = [], [], []
-        # loop around orders
+        # get the mask columns as native byte order float arrays (once)
+        mask_wave = np.asarray(mask_table['ll_mask_s'], dtype=float)
+        mask_weight = np.asarray(mask_table['w_mask'], dtype=float)
+        mask_snr = np.asarray(mask_table['line_snr'], dtype=float)
+        mask_depth = np.asarray(mask_table['depth'], dtype=float)
+        mask_value = np.asarray(mask_table['value'], dtype=float)
+        # first pass: find the mask lines in each order
+        order_lines = []
         for order_num in range(wavegrid.shape[0]):
             # get the min max wavelengths for this order
             min_wave = np.min(wavegrid[order_num])
             max_wave = np.max(wavegrid[order_num])
             # build a mask for mask lines in this order
-            good = mask_table['ll_mask_s'] > min_wave
-            good &= mask_table['ll_mask_s'] < max_wave
+            good = mask_wave > min_wave
+            good &= mask_wave < max_wave
             # if we pass a 'full' mask, then we only keep local maxima
             # only valid for science frames
             if params['DATA_TYPE'] == 'SCIENCE':
-                good &= mask_table['w_mask'] < 0
-
+                good &= mask_weight < 0
+            # store the positions of the lines in this order
+            order_lines.append(np.flatnonzero(good))
+        # each order gives one line per pair of consecutive mask lines
+        counts = [max(len(lines) - 1, 0) for lines in order_lines]
+        total = int(np.sum(counts))
+        # storage for vectors (allocated once)
+        order = np.zeros(total, dtype=int)
+        wave_start = np.zeros(total, dtype=mask_wave.dtype)
+        wave_end = np.zeros(total, dtype=mask_wave.dtype)
+        weight_line = np.zeros(total, dtype=mask_weight.dtype)
+        xpix = np.zeros(total, dtype=float)
+        line_snr = np.zeros(total, dtype=mask_snr.dtype)
+        line_depth = np.zeros(total, dtype=mask_depth.dtype)
+        local_flux = np.zeros(total, dtype=mask_value.dtype)
+        # second pass: fill the vectors order by order
+        start = 0
+        for order_num in range(wavegrid.shape[0]):
             # if we have values then add to arrays
-            if np.sum(good) > 0:
+            if len(order_lines[order_num]) > 0:
+                # the lines in this order (start and end of each line)
+                lines = order_lines[order_num]
+                istart, iend = lines[:-1], lines[1:]
+                # the slice of the vectors for this order
+                end = start + counts[order_num]
                 # add an order flag
-                order += list(np.repeat(order_num, np.sum(good) - 1))
+                order[start:end] = order_num
                 # get the wave starts
-                wave_start += list(mask_table['ll_mask_s'][good][:-1])
+                wave_start[start:end] = mask_wave[istart]
                 # get the wave ends
-                wave_end += list(mask_table['ll_mask_s'][good][1:])
+                wave_end[start:end] = mask_wave[iend]
                 # get the weights of the lines (only used to get systemic
                 # velocity as a starting point)
-                weight_line += list(mask_table['w_mask'][good][:-1])
+                weight_line[start:end] = mask_weight[istart]
                 # spline x pixels using wave grid
                 xgrid = np.arange(len(wavegrid[order_num]))
                 xspline = mp.iuv_spline(wavegrid[order_num], xgrid)
                 # get the x pixel vector for mask
-                xpix += list(xspline(mask_table['ll_mask_s'][good][:-1]))
+                xpix[start:end] = xspline(mask_wave[istart])
                 # get the line snr
-                line_snr += list(mask_table['line_snr'][good][:-1])
-                line_depth += list(mask_table['depth'][good][:-1])
-                local_flux += list(mask_table['value'][good][:-1])
-        # make xpix a numpy array
-        xpix = np.array(xpix)
+                line_snr[start:end] = mask_snr[istart]
+                line_depth[start:end] = mask_depth[istart]
+                local_flux[start:end] = mask_value[istart]
+                # move to the next order
+                start = end
         # add to reference dictionary
-        ref_dict['ORDER'] = np.array(order)
-        ref_dict['WAVE_START'] = np.array(wave_start)
-        ref_dict['WAVE_END'] = np.array(wave_end)
-        ref_dict['WEIGHT_LINE'] = np.array(weight_line)
+        ref_dict['ORDER'] = order
+        ref_dict['WAVE_START'] = wave_start
+        ref_dict['WAVE_END'] = wave_end
+        ref_dict['WEIGHT_LINE'] = weight_line
         ref_dict['XPIX'] = xpix
-        ref_dict['LINE_SNR'] = np.array(line_snr)
-        ref_dict['LINE_DEPTH'] = np.array(line_depth)
-        ref_dict['LOCAL_FLUX'] = np.array(local_flux)
+        ref_dict['LINE_SNR'] = line_snr
+        ref_dict['LINE_DEPTH'] = line_depth
+        ref_dict['LOCAL_FLUX'] = local_flux
         # ratio of expected VS actual RMS in difference of model vs line
         ref_dict['RMSRATIO'] = np.zeros_like(xpix, dtype=float)
         # effective number of pixels in line
@@ -280,18 +416,37 @@ def make_ref_dict(inst: InstrumentsType, reftable_file: str,
     return ref_dict
 
 
-def get_velo_scale(wave_vector: np.ndarray, hp_width: float) -> int:
+def get_velo_pixel(wave_vector: np.ndarray) -> Union[float, np.ndarray]:
+    """
+    Calculate the (median) velocity step of a pixel for a wave vector (for a
+    2D wave grid this is done for each order, i.e. along the last axis)
+
+    :param wave_vector: np.ndarray, the wave vector (or 2D wave grid)
+
+    :return: float or np.ndarray, the velocity of a pixel in m/s (one value
+             per order for a 2D wave grid)
+    """
+    # work out the velocity scale
+    dwave = np.gradient(wave_vector, axis=-1)
+    return 1 / mp.nanmedian((wave_vector / dwave) / speed_of_light_ms,
+                            axis=-1)
+
+
+def get_velo_scale(wave_vector: np.ndarray, hp_width: float,
+                   dvelo: Optional[float] = None) -> int:
     """
     Calculate the velocity scale give a wave vector and a hp width
 
     :param wave_vector: np.ndarray, the wave vector
     :param hp_width: float, the hp width
+    :param dvelo: float or None, if set this is the velocity of a pixel
+                  (from get_velo_pixel) and wave_vector is not used
 
     :return: int, the velocity scale in pixels
     """
     # work out the velocity scale
-    dwave = np.gradient(wave_vector)
-    dvelo = 1 / mp.nanmedian((wave_vector / dwave) / speed_of_light_ms)
+    if dvelo is None:
+        dvelo = get_velo_pixel(wave_vector)
     # velocity pixel scale (to nearest pixel)
     width = int(hp_width / dvelo)
     # make sure pixel width is odd
@@ -390,12 +545,16 @@ def spline_template(inst: InstrumentsType, template_file: str,
     # -------------------------------------------------------------------------
     # get the gradient of the log of the wave
     grad_log_wave = np.gradient(np.log(twave))
-    # get the derivative of the flux
-    dflux = np.gradient(tflux) / grad_log_wave / speed_of_light_ms
-    # get the 2nd derivative of the flux
-    d2flux = np.gradient(dflux) / grad_log_wave / speed_of_light_ms
-    # get the 3rd derivative of the flux
-    d3flux = np.gradient(d2flux) / grad_log_wave / speed_of_light_ms
+    # the 1st, 2nd and 3rd derivatives of the flux (each is the gradient of
+    #   the previous one, scaled in place to avoid temporary arrays)
+    derivs = []
+    flux_n = tflux
+    for _ in range(3):
+        flux_n = np.gradient(flux_n)
+        flux_n /= grad_log_wave
+        flux_n /= speed_of_light_ms
+        derivs.append(flux_n)
+    dflux, d2flux, d3flux = derivs
     # -------------------------------------------------------------------------
     # we create the spline of the template to be used everywhere later
     valid = np.isfinite(tflux) & np.isfinite(dflux)
@@ -459,7 +618,14 @@ def spline_template(inst: InstrumentsType, template_file: str,
     # we create a mask to know if the splined point  is valid
     tmask = np.isfinite(tflux).astype(float)
     ntwave1 = mp.doppler_shift(twave, systemic_vel)
-    sps['spline_mask'] = mp.iuv_spline(ntwave1, tmask, k=1, ext=1)
+    # if all template points are valid the mask is just zero outside the
+    #   template, in this case we do not need the spline (spline_mask=None)
+    #   and just use the template wavelength range
+    if np.all(tmask == 1):
+        sps['spline_mask'] = None
+    else:
+        sps['spline_mask'] = mp.iuv_spline(ntwave1, tmask, k=1, ext=1)
+    sps['spline_mask_range'] = (ntwave1[0], ntwave1[-1])
     # -------------------------------------------------------------------------
     # return splines
     return sps
@@ -531,21 +697,37 @@ def get_systemic_vel_props(inst: InstrumentsType, template_file: str,
     fluxgrid = np.array(sci_template_table['flux'])
     # fluxgrid = medfilt(fluxgrid, 3)
     # ---------------------------------------------------------------------
-    # spline the science temmplate
+    # linearly interpolate the science template (k=1 avoids ringing at edges
+    #   if 'good' has holes) - zero outside the template domain
     good = np.isfinite(fluxgrid)
-    # Use k=1 to avoid ringing at edges if 'good' has holes.
-    sps = mp.iuv_spline(wavegrid[good], fluxgrid[good], k=1, ext=1)
+    sps_wave, sps_flux = wavegrid[good], fluxgrid[good]
     # ---------------------------------------------------------------------
     # define the ccf dv grid
     dv = np.arange(rv_min, rv_max + rv_step, rv_step)
+    # get the mask lines and weights as numpy arrays
+    mask_wave = np.array(mask_table['ll_mask_s'], dtype=float)
+    mask_weight = np.array(mask_table['w_mask'], dtype=float)
+    # non-finite weights do not contribute to the ccf (as with nansum)
+    mask_weight[~np.isfinite(mask_weight)] = 0.0
     # storage for the ccf
     ccf_vector = np.zeros_like(dv)
-    # compute the ccf
-    for it in range(len(dv)):
-        # shift the mask by dv for this iteration
-        pos = mp.doppler_shift(mask_table['ll_mask_s'], -dv[it])
-        # calculate the ccf for this iteration
-        ccf_vector[it] = mp.nansum(mask_table['w_mask'] * sps(pos))
+    # compute the ccf for a block of dv elements at once (the mask shifted
+    #   by every dv in the block is a 2D array [n_dv, n_lines]) - blocks keep
+    #   the size of this array below ~2**22 elements
+    block_size = max(1, 2 ** 22 // max(len(mask_wave), 1))
+    for start in range(0, len(dv), block_size):
+        # get the dv elements for this block
+        dv_block = dv[start:start + block_size]
+        # shift the mask by each dv in this block
+        pos = mp.doppler_shift(mask_wave[None, :], -dv_block[:, None])
+        # interpolate the template at all positions (in one call)
+        sps_pos = np.interp(pos.ravel(), sps_wave, sps_flux, left=0.0,
+                            right=0.0).reshape(pos.shape)
+        # non-finite spline values do not contribute (as with nansum)
+        sps_pos[~np.isfinite(sps_pos)] = 0.0
+        # calculate the ccf for all dv elements in this block (the weighting
+        #   and the sum over lines in a single matrix-vector product)
+        ccf_vector[start:start + block_size] = sps_pos @ mask_weight
     # CCF can be normalized to its median as we have only used
     # features in absorption rather than the 'full'
     ccf_vector /= np.nanmedian(ccf_vector)
@@ -668,6 +850,45 @@ def get_magic_grid(wave0: float, wave1: float, dv_grid: float = 500):
     return magic_grid
 
 
+# Set "nopython" mode for best performance, equivalent to @njit
+@mp.jit(nopython=True, cache=True)
+def ccf_kernel(magic_spline: np.ndarray, index_mask: np.ndarray,
+               istep: np.ndarray, weight_line: np.ndarray) -> np.ndarray:
+    """
+    The inner CCF loop of rough_ccf_rv - for each velocity step sum the
+    weighted spectrum at the (shifted) position of each mask line
+
+    Note this is compiled with numba as it loops over every velocity step
+    and every line for every science file (without numba rough_ccf_rv uses
+    the vectorized numpy version instead)
+
+    :param magic_spline: np.ndarray, the spectrum on the magic grid (float32)
+    :param index_mask: np.ndarray, the position of each line on the magic grid
+    :param istep: np.ndarray, the velocity steps (in magic grid pixels)
+    :param weight_line: np.ndarray, the weight of each mask line (float32)
+
+    :return: np.ndarray, the ccf vector (one value per velocity step)
+    """
+    # set up the CCF vector for all rv elements
+    ccf_vector = np.zeros(len(istep))
+    # now loop around the dv elements
+    for dv_element in range(len(istep)):
+        # ccf vector at this dv element is the sum of the ccf for each index
+        #   (multiplied by the weight of the line) - equivalent to a nansum
+        #   but without a temporary array per dv element
+        total = 0.0
+        for line_it in range(len(index_mask)):
+            pos = index_mask[line_it] - istep[dv_element]
+            # accumulate in float64
+            value = np.float64(magic_spline[pos]) * weight_line[line_it]
+            # skip NaNs (as nansum)
+            if not np.isnan(value):
+                total += value
+        ccf_vector[dv_element] = total
+    # return the ccf vector
+    return ccf_vector
+
+
 def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
                  sci_data: np.ndarray, wave_mask: np.ndarray,
                  weight_line: np.ndarray, kind: str) -> Tuple[float, float]:
@@ -694,20 +915,12 @@ def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
     if wavegrid.shape[0] > 1:
         # 2D mask for making 2D --> 1D
         mask = np.ones_like(wavegrid, dtype=bool)
-        # only include wavelengths for this order that don't overlap with
-        #   the previous order
-        for order_num in range(1, wavegrid.shape[0]):
-            # elements where wavegrid doesn't overlap with previous
-            porder = wavegrid[order_num] > wavegrid[order_num - 1, ::-1]
-            # add to mask
-            mask[order_num] &= porder
-        # only include wavelengths for this order that don't overlap with the
-        #   next order
-        for order_num in range(0, wavegrid.shape[0] - 1):
-            # elements where wavegrid doesn't overlap with next order
-            norder = wavegrid[order_num] < wavegrid[order_num + 1, ::-1]
-            # add to mask
-            mask[order_num] &= norder
+        # only include wavelengths for each order that don't overlap with
+        #   the previous order (all orders at once)
+        mask[1:] &= wavegrid[1:] > wavegrid[:-1, ::-1]
+        # only include wavelengths for each order that don't overlap with
+        #   the next order (all orders at once)
+        mask[:-1] &= wavegrid[:-1] < wavegrid[1:, ::-1]
         # make sure no NaNs present
         mask &= np.isfinite(sci_data)
         # make the sci_data and wave grid are 1d
@@ -723,8 +936,6 @@ def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
     # -------------------------------------------------------------------------
     # Make a magic grid to use in the CCF
     # -------------------------------------------------------------------------
-    # spline the science data
-    spline_sp = mp.iuv_spline(wavegrid2, sci_data2, k=1, ext=1)
     # min wavelength in domain
     wave0 = float(np.nanmin(wavegrid2))
     # maxwavelength in domain
@@ -736,12 +947,16 @@ def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
     grid_step = get_velocity_step(wavegrid2)
     # get the magic wave grid
     magic_grid = get_magic_grid(wave0, wave1, dv_grid=grid_step)
-    # spline the magic grid
-    magic_spline = spline_sp(magic_grid)
-    # define a spline across the magic grid
-    index_spline = mp.iuv_spline(magic_grid, np.arange(len(magic_grid)))
-    # we find the position along the magic grid for the CCF lines
-    index_mask = np.array(index_spline(wave_mask) + 0.5, dtype=int)
+    # linearly interpolate the science data onto the magic grid (zero outside
+    #   the science domain)
+    magic_spline = np.interp(magic_grid, wavegrid2, sci_data2, left=0.0,
+                             right=0.0)
+    # we find the position along the magic grid for the CCF lines (in one
+    #   batched interpolation rather than splining the whole magic grid),
+    #   lines outside the grid land on the first/last element and are
+    #   removed by the keep_line mask below
+    index_mask = np.interp(wave_mask, magic_grid, np.arange(len(magic_grid)))
+    index_mask = np.array(index_mask + 0.5, dtype=int)
 
     # -------------------------------------------------------------------------
     # perform the CCF
@@ -750,20 +965,28 @@ def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
     istep = np.arange(int(rv_min / grid_step), int(rv_max / grid_step))
     # define the dv grid from the initial steps in pixels * rv step
     dvgrid = istep * grid_step
-    # set up the CCF vector for all rv elements
-    ccf_vector = np.zeros(len(istep))
     # define a mask that only keeps certain index values
     keep_line = index_mask > (rv_max / grid_step) + 2
     keep_line &= index_mask < len(magic_spline) - (rv_max / grid_step) - 2
     # only keep the indices and weights within the keep line mask
     index_mask = index_mask[keep_line]
-    weight_line = weight_line[keep_line]
-    # now loop around the dv elements
-    for dv_element in range(len(istep)):
-        # get the ccf for each index (and multiply by weight of the line
-        ccf_indices = magic_spline[index_mask - istep[dv_element]] * weight_line
-        # ccf vector at this dv element is the sum of these ccf values
-        ccf_vector[dv_element] = mp.nansum(ccf_indices)
+    weight_line = np.array(weight_line[keep_line], dtype=np.float32)
+    # the rough CCF only needs to locate the peak (photon noise is far larger
+    #   than single precision) so gather the spectrum in float32 to halve
+    #   the memory traffic (the sum itself is accumulated in float64)
+    magic_spline = magic_spline.astype(np.float32)
+    # compute the ccf vector for all rv elements (compiled loop)
+    if mp.HAS_NUMBA:
+        ccf_vector = ccf_kernel(magic_spline, index_mask, istep, weight_line)
+    # without numba we loop around the dv elements and vectorize the lines
+    else:
+        ccf_vector = np.zeros(len(istep))
+        for dv_element in range(len(istep)):
+            # get the ccf for each index (and multiply by weight of the line
+            ccf_indices = magic_spline[index_mask - istep[dv_element]]
+            ccf_indices = ccf_indices.astype(float) * weight_line
+            # ccf vector at this dv element is the sum of these ccf values
+            ccf_vector[dv_element] = mp.nansum(ccf_indices)
 
     # high-pass the CCF just to be really sure that we are finding a true CCF
     # peak and not a spurious excursion in the low-frequencies
@@ -789,9 +1012,10 @@ def rough_ccf_rv(inst: InstrumentsType, wavegrid: np.ndarray,
     guess = [dvgrid[ccfmin], rv_ewid_guess, ccf_amp, ccf_dc, 0.0]
     # set specific func name for curve fit errors
     sfuncname = '{0}.KIND={1}'.format(func_name, kind)
-    # push into curve fit
+    # push into curve fit (with the analytic jacobian, avoiding the finite
+    #   difference evaluations of the model)
     gcoeffs, pcov = mp.curve_fit(mp.gauss_fit_s, dvgrid, ccf_vector, p0=guess,
-                                 funcname=sfuncname)
+                                 jac=mp.gauss_fit_s_jac, funcname=sfuncname)
     # record the systemic velocity and the FWHM
     systemic_velocity = gcoeffs[0]
     ccf_ewidth = abs(gcoeffs[1])
@@ -879,9 +1103,57 @@ def get_scaling_ratio(spectrum1: np.ndarray,
     return amp
 
 
+# Set "nopython" mode for best performance, equivalent to @njit
+@mp.jit(nopython=True, cache=True)
+def noise_box_sigma(residuals: np.ndarray, indices: np.ndarray, npoints: int,
+                    sig_percentile: float) -> np.ndarray:
+    """
+    Work out the robust sigma of the residuals in a box of npoints around
+    each index (same as mp.estimate_sigma on each box)
+
+    Note this is compiled with numba (when available) as it is called for
+    every order in every iteration of compute_rv (with the noise model)
+
+    :param residuals: np.ndarray, the residuals (spectrum - model) for an order
+    :param indices: np.ndarray, the box centers (pixel positions)
+    :param npoints: int, the box width in pixels
+    :param sig_percentile: float, the percentile that corresponds to +1 sigma
+
+    :return: np.ndarray, the sigma in each box (zero if the box has less than
+             50% valid points)
+    """
+    # store the sigmas
+    sigma = np.zeros(len(indices))
+    # loop around each pixel and work out sigma value
+    for it in range(len(indices)):
+        # get start and end values for this box
+        istart = indices[it] - npoints // 2
+        iend = indices[it] + npoints // 2
+        # fix boundary problems
+        if istart < 0:
+            istart = 0
+        if iend > len(residuals):
+            iend = len(residuals)
+        tmp = residuals[istart: iend]
+        # if more than 50% of the points are valid. If shorter at the
+        # start or end of domain, we compare to npoints rather than the
+        # length of tmp
+        frac_valid = np.sum(np.isfinite(tmp)) / npoints
+        if frac_valid > 0.5:
+            # work out the lower and upper percentiles for 1 sigma
+            upper = np.nanpercentile(tmp, sig_percentile)
+            lower = np.nanpercentile(tmp, 100 - sig_percentile)
+            # the sigma of this box is the mean of these two bounds
+            sigma[it] = (upper - lower) / 2.0
+    # return the sigmas
+    return sigma
+
+
 def estimate_noise_model(spectrum: np.ndarray, wavegrid: np.ndarray,
                          model: np.ndarray,
-                         noise_sampling_width: float) -> np.ndarray:
+                         noise_sampling_width: float,
+                         rms_out: Optional[np.ndarray] = None,
+                         dvelo: Optional[np.ndarray] = None) -> np.ndarray:
     """
     Estimate the noise on spectrum given the model
 
@@ -890,51 +1162,68 @@ def estimate_noise_model(spectrum: np.ndarray, wavegrid: np.ndarray,
     :param model: np.ndarray, the model
     :param noise_sampling_width: float, the width of the window used to sample
                                    the noise.
+    :param rms_out: np.ndarray or None, if set the rms is written into this
+                    array (same shape as spectrum) instead of a new array
+    :param dvelo: np.ndarray or None, if set the velocity of a pixel for each
+                  order (from get_velo_pixel) otherwise calculated from
+                  wavegrid
 
     :return: np.ndarray, the rms vector for this spectrum give the model
     """
     # storage for output rms
-    rms = np.zeros_like(spectrum)
+    if rms_out is None:
+        rms = np.zeros_like(spectrum)
+    else:
+        rms = rms_out
+        rms[:] = 0.0
+    # get the 1 sigma as a percentile (as in mp.estimate_sigma)
+    sig_percentile = (1 - (1 - mp.normal_fraction(1.0)) / 2) * 100
+    # get the velocity of a pixel in each order
+    if dvelo is None:
+        dvelo = get_velo_pixel(wavegrid)
     # loop around each order and estimate noise model
     for order_num in range(spectrum.shape[0]):
-        # get the wavelength for this order
-        waveord = wavegrid[order_num]
         # calculate the number of points for the sliding error rms
-        npoints = get_velo_scale(waveord, noise_sampling_width)
+        npoints = get_velo_scale(wavegrid[order_num], noise_sampling_width,
+                                 dvelo=dvelo[order_num])
         # get the residuals between science and model
         residuals = spectrum[order_num] - model[order_num]
         # get the pixels along the model to spline at (box centers)
         indices = np.arange(0, model.shape[1], npoints // 4)
-        # store the sigmas
-        sigma = np.zeros_like(indices, dtype=float)
-        # loop around each pixel and work out sigma value
-        for it in range(len(indices)):
-            # get start and end values for this box
-            istart = indices[it] - npoints // 2
-            iend = indices[it] + npoints // 2
-            # fix boundary problems
-            if istart < 0:
-                istart = 0
-            if iend > model.shape[1]:
-                iend = model.shape[1]
-            tmp = residuals[istart: iend]
-            # if more than 50% of the points are valid. If shorter at the
-            # start or end of domain, we compare to npoints rather than the
-            # length of tmp
-            frac_valid = np.sum(np.isfinite(tmp)) / npoints
-            if frac_valid > 0.5:
-                # work out the sigma of this box
-                sigma[it] = mp.estimate_sigma(tmp)
-            # set any zero values to NaN
-            sigma[sigma == 0] = np.nan
+        # work out the sigma value in each box (compiled loop)
+        if mp.HAS_NUMBA:
+            sigma = noise_box_sigma(residuals, indices, npoints,
+                                    sig_percentile)
+        # without numba we take all boxes at once as windows of the
+        #   residuals (padded with NaNs to deal with the boundaries)
+        else:
+            half = npoints // 2
+            sigma = np.zeros(len(indices))
+            padded = np.full(len(residuals) + 2 * half, np.nan)
+            padded[half:half + len(residuals)] = residuals
+            boxes = np.lib.stride_tricks.sliding_window_view(padded,
+                                                             2 * half)
+            boxes = boxes[indices]
+            # only boxes with more than 50% of npoints valid
+            valid = np.sum(np.isfinite(boxes), axis=1) / npoints > 0.5
+            if np.sum(valid) > 0:
+                with warnings.catch_warnings(record=True) as _:
+                    upper, lower = np.nanpercentile(boxes[valid],
+                                                    [sig_percentile,
+                                                     100 - sig_percentile],
+                                                    axis=1)
+                sigma[valid] = (upper - lower) / 2.0
+        # set any zero values to NaN
+        sigma[sigma == 0] = np.nan
         # mask all NaN values
         good = np.isfinite(sigma)
         # if we have enough points calculate the rms
         if np.sum(good) > 2:
-            # get the spline across all indices
-            rms_spline = mp.iuv_spline(indices[good], sigma[good], k=1, ext=1)
-            # apply the spline to the model positions
-            rms[order_num] = rms_spline(np.arange(model.shape[1]))
+            # linearly interpolate across all indices to the model positions
+            #   (zero outside the box centers, as a k=1, ext=1 spline)
+            rms[order_num] = np.interp(np.arange(model.shape[1]),
+                                       indices[good], sigma[good],
+                                       left=0.0, right=0.0)
         # else we don't have a noise model
         else:
             # we fill the rms with NaNs for each pixel
@@ -944,30 +1233,152 @@ def estimate_noise_model(spectrum: np.ndarray, wavegrid: np.ndarray,
     return rms
 
 
-def bouchy_equation_line(vector: np.ndarray, diff_vector: np.ndarray,
-                         mean_rms: np.ndarray) -> Tuple[float, float]:
+def sum_by_line(values: np.ndarray, line_id: np.ndarray, nlines: int,
+                ignore_nan: bool = False) -> np.ndarray:
     """
-    Apply the Bouchy 2001 equation to a vector for the diff
+    Sum the values of pixels belonging to each line (for flattened line
+    segments, where line_id gives the line of each pixel)
 
-    :param vector: np.ndarray, the vector
-    :param diff_vector: np.ndarray, the difference between model and vector
-                             i.e. diff = (vector - model) * weights
-    :param mean_rms: np.ndarray, the mean rms for this line
+    :param values: np.ndarray, the value of each pixel
+    :param line_id: np.ndarray, the line (0 to nlines-1) each pixel belongs to
+    :param nlines: int, the number of lines
+    :param ignore_nan: bool, if True NaN values are ignored (as a nansum)
 
-    :return: tuple, 1. float, the Bouchy line value, 2. float, the rms of the
-             Bouchy line value
+    :return: np.ndarray, the sum of each line (length nlines)
     """
-    with warnings.catch_warnings(record=True) as _:
-        # work out the rms
-        rms_pix = mean_rms / vector
+    # deal with ignoring NaNs
+    if ignore_nan:
+        values = np.where(np.isnan(values), 0.0, values)
+    # sum all pixels of each line in one pass
+    return np.bincount(line_id, weights=values, minlength=nlines)
+
+
+# Set "nopython" mode for best performance, error_model="numpy" keeps the
+#   numpy behaviour (inf/nan instead of ZeroDivisionError) on division by zero
+@mp.jit(nopython=True, error_model='numpy', cache=True)
+def bouchy_kernel(vector: np.ndarray, diff_vector: np.ndarray,
+                  mean_rms: np.ndarray, orders: np.ndarray,
+                  x_starts: np.ndarray, x_ends: np.ndarray,
+                  weight_starts: np.ndarray, weight_ends: np.ndarray
+                  ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compiled loop of bouchy_equation_lines (all inputs must be native byte
+    order arrays - use bouchy_equation_lines)
+
+    :param vector: np.ndarray, the 2D vector (orders x pixels)
+    :param diff_vector: np.ndarray, the 2D difference between model and vector
+                        (not weighted) i.e. diff = (vector - model)
+    :param mean_rms: np.ndarray, the mean rms for each line
+    :param orders: np.ndarray, the order of each line
+    :param x_starts: np.ndarray, the first pixel of each line
+    :param x_ends: np.ndarray, the last pixel of each line
+    :param weight_starts: np.ndarray, the weight of the first pixel of each
+                          line
+    :param weight_ends: np.ndarray, the weight of the last pixel of each line
+
+    :return: tuple, 1. np.ndarray, the Bouchy line values, 2. np.ndarray, the
+             rms of the Bouchy line values
+    """
+    # storage for the outputs
+    values = np.zeros(len(orders))
+    rms_values = np.zeros(len(orders))
+    # loop around lines
+    for it in range(len(orders)):
+        order_num = orders[it]
+        sum_vector2 = 0.0
+        sum_diff = 0.0
+        # loop around the pixels in this line
+        for pix in range(x_starts[it], x_ends[it] + 1):
+            # get the weight of this pixel (the last pixel takes precedence)
+            if pix == x_ends[it]:
+                weight = weight_ends[it]
+            elif pix == x_starts[it]:
+                weight = weight_starts[it]
+            else:
+                weight = 1.0
+            # weight the vector and the diff
+            wvector = vector[order_num, pix] * weight
+            wdiff = diff_vector[order_num, pix] * weight
+            # sum of the vector squared and of the diff x vector
+            sum_vector2 += wvector ** 2
+            sum_diff += wdiff * wvector
         # work out the RV error
-        rms_value = 1 / np.sqrt(np.sum(1 / rms_pix ** 2))
+        rms_values[it] = mean_rms[it] / np.sqrt(sum_vector2)
         # feed the line
         # nansum can break here - subtle: must be a sum
         #   nansum --> 0 / 0  [breaks]   sum --> nan / nan [works]
-        value = np.sum(diff_vector * vector) / np.sum(vector ** 2)
-    # return the value and rms of the value
-    return value, rms_value
+        values[it] = sum_diff / sum_vector2
+    # return the values and rms of the values
+    return values, rms_values
+
+
+def bouchy_equation_lines(vector: np.ndarray, diff_vector: np.ndarray,
+                          mean_rms: np.ndarray, orders: np.ndarray,
+                          x_starts: np.ndarray, x_ends: np.ndarray,
+                          weight_starts: np.ndarray, weight_ends: np.ndarray
+                          ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Apply the Bouchy 2001 equation to many lines in one call. The segment of
+    each line is x_start to x_end (inclusive) in its order, all pixels have a
+    weight of 1 except the first and last pixel (weight_start and weight_end)
+
+    For each line: value = sum(diff x vector) / sum(vector ** 2) and
+    rms = mean_rms / sqrt(sum(vector ** 2)) with the weighted vector and diff
+    (sum(1 / rms_pix ** 2) = sum(vector ** 2) / mean_rms ** 2)
+
+    :param vector: np.ndarray, the 2D vector (orders x pixels)
+    :param diff_vector: np.ndarray, the 2D difference between model and vector
+                        (not weighted) i.e. diff = (vector - model)
+    :param mean_rms: np.ndarray, the mean rms for each line
+    :param orders: np.ndarray, the order of each line
+    :param x_starts: np.ndarray, the first pixel of each line
+    :param x_ends: np.ndarray, the last pixel of each line
+    :param weight_starts: np.ndarray, the weight of the first pixel of each
+                          line
+    :param weight_ends: np.ndarray, the weight of the last pixel of each line
+
+    :return: tuple, 1. np.ndarray, the Bouchy line values, 2. np.ndarray, the
+             rms of the Bouchy line values
+    """
+    # numba only accepts native byte order (tables read from fits are
+    #   big-endian) - this does not copy arrays that are already native
+    vector = np.ascontiguousarray(vector, dtype=float)
+    diff_vector = np.ascontiguousarray(diff_vector, dtype=float)
+    mean_rms = np.ascontiguousarray(mean_rms, dtype=float)
+    orders = np.ascontiguousarray(orders, dtype=int)
+    x_starts = np.ascontiguousarray(x_starts, dtype=int)
+    x_ends = np.ascontiguousarray(x_ends, dtype=int)
+    weight_starts = np.ascontiguousarray(weight_starts, dtype=float)
+    weight_ends = np.ascontiguousarray(weight_ends, dtype=float)
+    # apply the Bouchy equation to each line (compiled loop)
+    if mp.HAS_NUMBA:
+        return bouchy_kernel(vector, diff_vector, mean_rms, orders, x_starts,
+                             x_ends, weight_starts, weight_ends)
+    # without numba we flatten the pixels of all lines (pixel k belongs to
+    #   line line_id[k]) and sum each line with sum_by_line
+    nlines = len(orders)
+    npix_line = x_ends - x_starts + 1
+    line_id = np.repeat(np.arange(nlines), npix_line)
+    first_pix = np.cumsum(npix_line) - npix_line
+    xpix = x_starts[line_id] + np.arange(len(line_id)) - first_pix[line_id]
+    opix = orders[line_id]
+    # the weight of each pixel (the last pixel takes precedence)
+    weight = np.ones(len(line_id))
+    weight[first_pix] = weight_starts
+    weight[first_pix + npix_line - 1] = weight_ends
+    # weight the vector and the diff
+    wvector = vector[opix, xpix] * weight
+    wdiff = diff_vector[opix, xpix] * weight
+    # sum of the vector squared and of the diff x vector
+    sum_vector2 = sum_by_line(wvector ** 2, line_id, nlines)
+    sum_diff = sum_by_line(wdiff * wvector, line_id, nlines)
+    with warnings.catch_warnings(record=True) as _:
+        # work out the RV error
+        rms_values = mean_rms / np.sqrt(sum_vector2)
+        # the line values (must be a sum not a nansum)
+        values = sum_diff / sum_vector2
+    # return the values and rms of the values
+    return values, rms_values
 
 
 def compute_rv(inst: InstrumentsType, sci_iteration: int,
@@ -1019,6 +1430,8 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     compute_rv_n_iters = inst.params['COMPUTE_RV_N_ITERATIONS']
     # get plot order
     model_plot_orders = inst.params['COMPUTE_MODEL_PLOT_ORDERS']
+    # only keep the line segments for the line plot if we are plotting it
+    plot_lines = inst.params['PLOT'] and inst.params['PLOT_COMPUTE_LINES']
     # get the minimum line width (in pixels) to consider line valid
     min_line_width = inst.params['COMPUTE_LINE_MIN_PIX_WIDTH']
     # get the threshold in sigma on nsig (dv / dvrms) to keep valid
@@ -1035,6 +1448,11 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     readout_noise = inst.params['READ_OUT_NOISE']
     # flag that we have residual projection tables
     resproj_flag = isinstance(inst.params['RESPROJ_TABLES'], dict)
+    # resolve the residual projection keys once (not per order / per line)
+    if resproj_flag:
+        resproj_keys = list(inst.params['RESPROJ_TABLES'].keys())
+    else:
+        resproj_keys = []
     # get the size of running window sample = noise
     noise_sampling_width = inst.params['NOISE_SAMPLING_WIDTH']
     # -------------------------------------------------------------------------
@@ -1053,6 +1471,12 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
         rms = np.zeros_like(sci_data)
     else:
         rms = np.sqrt(np.abs(sci_data) + readout_noise ** 2)
+    # work space for the sigma clipping (reused every iteration)
+    nsig_2d = np.zeros_like(sci_data)
+    sigmask = np.zeros(sci_data.shape, dtype=bool)
+    # work space for the science minus model difference (reused every
+    #   iteration)
+    diff_2d = np.zeros_like(sci_data)
     # -------------------------------------------------------------------------
     # copy science data
     sci_data0 = np.array(sci_data)
@@ -1078,6 +1502,9 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     berv = inst.get_berv(sci_hdr)
     inst.params['BERV'] = berv
 
+    # the velocity of a pixel in each order (the wave grid does not change
+    #   during compute_rv so this is only done once)
+    dvelo_orders = get_velo_pixel(wavegrid)
     width = np.zeros(sci_data.shape[0], dtype=int)
     for order_num in range(sci_data.shape[0]):  # TODO change back to hp_width
         # within each order, we determine the median width of lines and
@@ -1094,7 +1521,8 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
 
         med_line_width = np.nanmedian(starts / ends - 1) * speed_of_light_ms
         hp_width = 5 * med_line_width
-        width[order_num] = get_velo_scale(wavegrid[order_num], hp_width)
+        width[order_num] = get_velo_scale(wavegrid[order_num], hp_width,
+                                          dvelo=dvelo_orders[order_num])
 
     # -------------------------------------------------------------------------
     # Systemic velocity estimate
@@ -1162,7 +1590,7 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     # only need to fill this if we have residual projection tables
     if resproj_flag:
         # loop around residual projection tables
-        for key in inst.params['RESPROJ_TABLES']:
+        for key in resproj_keys:
             # each projection model has a model, proj and sproj
             #  we fill them with empty arrays to start with
             proj_model[key] = dict()
@@ -1180,6 +1608,11 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     d2spline = splines['d2spline']
     d3spline = splines['d3spline']
     spline_mask = splines['spline_mask']
+    # the template splines share their knots, so evaluate them together
+    #   (d2spline and d3spline are only needed on the last iteration)
+    spline_stack = mp.StackedSpline([spline0, dspline])
+    spline_stack_last = mp.StackedSpline([spline0, dspline, d2spline,
+                                          d3spline])
     # set up storage for the dv, d2v, d3v and corresponding rms values
     #    fill with NaNs
     dv = np.full(len(ref_table['WAVE_START']), np.nan)
@@ -1192,7 +1625,29 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     sd3v = np.full(len(ref_table['WAVE_START']), np.nan)
     # keep track of the fraction of each line that is valid
     frac_line_valid = np.zeros(len(ref_table['WAVE_START']))
-
+    # the lines in each order and their start and end wavelengths (these do
+    #   not change between iterations so we only find them once). The start
+    #   and end wavelengths are joined so each order needs a single binary
+    #   search per iteration
+    line_groups = []
+    line_sort = np.argsort(ref_table['ORDER'], kind='stable')
+    group_orders, group_starts = np.unique(ref_table['ORDER'][line_sort],
+                                           return_index=True)
+    for order_num, order_lines in zip(group_orders,
+                                      np.split(line_sort, group_starts[1:])):
+        lwave_bounds = np.concatenate([ref_table['WAVE_START'][order_lines],
+                                       ref_table['WAVE_END'][order_lines]])
+        line_groups.append((order_num, order_lines, lwave_bounds))
+    # storage for the start and end pixels of every line
+    x_start_all = np.zeros(len(ref_table['ORDER']), dtype=int)
+    x_end_all = np.zeros(len(ref_table['ORDER']), dtype=int)
+
+    # orders with <3 lines (width=0) are never modelled, so the model update
+    #   only ever works on the valid orders
+    valid_orders = np.flatnonzero(width != 0)
+    # storage for the wave grid shifted by the systemic velocity (updated
+    #   every iteration)
+    nwavegrid = np.empty_like(wavegrid)
     # stoarge for final rv values
     rv_final = np.full(len(ref_table['WAVE_START']), np.nan)
     # storage for plotting
@@ -1225,46 +1680,54 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
             model_offset = float(model_velocity)
         else:
             model_offset = 0
-        # loop around each order and update model, dmodel, d2model, d3model
-        for order_num in range(sci_data.shape[0]):
-            # flags orders that have <3 lines
-            # do not spend time on this order computing anything
-            if width[order_num] == 0:
-                continue
-            # doppler shifted wave grid for this order
-            shift = -sys_rv - model_offset
-            wave_ord = mp.doppler_shift(wavegrid[order_num], shift)
-            # get the blaze for this order
-            blaze_ord = blaze[order_num]
-            # get the low-frequency component out
-            model_mask = np.ones_like(model[order_num])
-            # add the spline mask values to model_mask (spline mask is 0 or 1)
-            smask = spline_mask(wave_ord) < 0.99
-            # set spline mask splined values to NaN
-            model_mask[smask] = np.nan
-            # RV shift the spline and correct for blaze and add model mask
-            # TODO spline0 or spline depending on the type of filtering and
-            #      normalization
-            model[order_num] = spline0(wave_ord) * blaze_ord * model_mask
-            # we are so close in RV with RV_mean<10*sigma that there is no need
-            # to do the low-pass filtering again
-            if iteration == 0:
-                do_hp = True
-                # nsig_rv_mean = np.inf
+        # doppler shifted wave grid for all valid orders
+        shift = -sys_rv - model_offset
+        wave_valid = mp.doppler_shift(wavegrid[valid_orders], shift)
+        # flatten so each spline is only called once for all orders
+        wave_flat = wave_valid.ravel()
+        # get the blaze for the valid orders
+        blaze_valid = blaze[valid_orders]
+        # the spline mask values (spline mask is 0 or 1) become the
+        #   model mask, with splined values set to NaN
+        if spline_mask is None:
+            # all template points are valid, only mask outside the template
+            smask = wave_valid < splines['spline_mask_range'][0]
+            smask |= wave_valid > splines['spline_mask_range'][1]
+        else:
+            smask = spline_mask(wave_flat).reshape(wave_valid.shape) < 0.99
+        model_mask = np.where(smask, np.nan, 1.0)
+        # RV shift the template and its derivatives (evaluated once,
+        #   spline0 is also used for model0)
+        if flag_last_iter:
+            sout = spline_stack_last(wave_flat)
+        else:
+            sout = spline_stack(wave_flat)
+        sout = [svalues.reshape(wave_valid.shape) for svalues in sout]
+        spline0_valid, dspline_valid = sout[0], sout[1]
+        # correct the shifted template for blaze and add model mask
+        # TODO spline0 or spline depending on the type of filtering and
+        #      normalization
+        model[valid_orders] = spline0_valid * blaze_valid * model_mask
+        # we are so close in RV with RV_mean<10*sigma that there is no need
+        # to do the low-pass filtering again
+        if iteration == 0:
+            do_hp = True
+            # nsig_rv_mean = np.inf
+        else:
+            nsig_rv_mean = np.abs(rv_mean) / bulk_error
+            if nsig_rv_mean > 10:
+                do_hp = True  # too far from 0, do the high-pass filtering
             else:
-                nsig_rv_mean = np.abs(rv_mean) / bulk_error
-                if nsig_rv_mean > 10:
-                    do_hp = True  # too far from 0, do the high-pass filtering
-                else:
-                    do_hp = False
-
+                do_hp = False
+        if do_hp:
+            log.general('\t\tLow-pass match of model to science ratio')
+        # the low-pass filter and model0 normalisation are per order
+        for it, order_num in enumerate(valid_orders):
             if do_hp:
                 part1 = sci_data[order_num]
                 part2 = model[order_num]
                 part2[part2 == 0] = np.nan
                 ratio[order_num] = mp.lowpassfilter(part1 / part2, int(width[order_num]), k=3)
-                if order_num == 0:
-                    log.general('\t\tLow-pass match of model to science ratio')
 
             model[order_num] *= ratio[order_num]
 
@@ -1279,7 +1742,7 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
             # if this is the first iteration update model0
             if iteration == 0:
                 # spline the original template and apply blaze
-                model0[order_num] = spline0(wave_ord) * blaze_ord
+                model0[order_num] = spline0_valid[it] * blaze_valid[it]
                 model0[order_num][model0[order_num] == 0] = np.nan
                 # get the good values for the median
                 valid = np.isfinite(model0[order_num])
@@ -1294,27 +1757,28 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
                 # multiply by the median of the original spectrum
                 with warnings.catch_warnings(record=True):
                     model0[order_num] = model0[order_num] * med_sci_data_0
-            # update the other splines
-            # track ratio if relevant
-            dmodel[order_num] = dspline(wave_ord) * blaze_ord * ratio[order_num]
-            # only do the d2 and d3 stuff if on last iteration
-            if flag_last_iter:
-                d2model_ord = d2spline(wave_ord) * blaze_ord * ratio[order_num]
-                d3model_ord = d3spline(wave_ord) * blaze_ord * ratio[order_num]
-                d2model[order_num] = d2model_ord
-                d3model[order_num] = d3model_ord
-                # deal with residual projection tables if required
-                if resproj_flag:
-                    # loop around residual project tables
-                    for key in inst.params['RESPROJ_TABLES']:
-                        # calculate spline
-                        rp_spline = splines[key](wave_ord)
-                        # The models are always expressed in terms of the
-                        # original spectrum
-                        rblaze = np.nanmedian(sci_data0[order_num] / blaze_ord)
-                        rp_spline *= (blaze_ord * rblaze)
-                        # add to projection model
-                        proj_model[key]['model'][order_num] = rp_spline
+        # update the other splines (for all valid orders at once)
+        # track ratio if relevant
+        ratio_valid = ratio[valid_orders]
+        dmodel[valid_orders] = dspline_valid * blaze_valid * ratio_valid
+        # only do the d2 and d3 stuff if on last iteration
+        if flag_last_iter:
+            d2model[valid_orders] = sout[2] * blaze_valid * ratio_valid
+            d3model[valid_orders] = sout[3] * blaze_valid * ratio_valid
+            # deal with residual projection tables if required
+            if resproj_flag:
+                # loop around residual project tables
+                for key in resproj_keys:
+                    # calculate spline
+                    rp_spline = splines[key](wave_flat)
+                    rp_spline = rp_spline.reshape(wave_valid.shape)
+                    # The models are always expressed in terms of the
+                    # original spectrum
+                    rblaze = np.nanmedian(sci_data0[valid_orders] /
+                                          blaze_valid, axis=1)
+                    rp_spline *= (blaze_valid * rblaze[:, None])
+                    # add to projection model
+                    proj_model[key]['model'][valid_orders] = rp_spline
         # ---------------------------------------------------------------------
         # estimate rms
         # ---------------------------------------------------------------------
@@ -1322,12 +1786,15 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
         if not use_noise_model:
 
             rms = estimate_noise_model(sci_data, wavegrid, model,
-                                       noise_sampling_width)
-            # work out the number of sigma away from the model
-            nsig = (sci_data - model) / rms
-            # mask for nsigma
+                                       noise_sampling_width, rms_out=rms,
+                                       dvelo=dvelo_orders)
+            # mask for nsigma (in place to avoid new arrays every iteration)
             with warnings.catch_warnings(record=True) as _:
-                sigmask = np.abs(nsig) > rms_sigclip_thres
+                # work out the number of sigma away from the model
+                np.subtract(sci_data, model, out=nsig_2d)
+                np.divide(nsig_2d, rms, out=nsig_2d)
+                np.abs(nsig_2d, out=nsig_2d)
+                np.greater(nsig_2d, rms_sigclip_thres, out=sigmask)
             # apply sigma clip to the science data
             sci_data[sigmask] = np.nan
         else:
@@ -1345,19 +1812,23 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
         # ---------------------------------------------------------------------
         # get orders
         orders = ref_table['ORDER']
-        # keep track of which order we are looking at
-        current_order = None
-        # set these for use/update later
-        nwavegrid = mp.doppler_shift(wavegrid, -sys_rv)
-        # get splines between shifted wave grid and pixel grid
-        wave2pixlist = []
-        xpix = np.arange(model.shape[1])
-        for order_num in range(wavegrid.shape[0]):
-            wave2pixlist.append(mp.iuv_spline(nwavegrid[order_num], xpix))
+        # set these for use/update later (shifted in place, the shift
+        #   changes every iteration)
+        mp.doppler_shift(wavegrid, -sys_rv, out=nwavegrid)
+        # find the pixel that contains the start and end of every line in
+        #   one binary search per order (pixel i covers ww[i] <= w < ww[i+1]
+        #   i.e. the floor of the pixel position), lines off the grid end up
+        #   at -1 or the last pixel and are rejected by the boundary checks
+        for order_num, order_lines, lwave_bounds in line_groups:
+            # the start and end pixels of the lines in this order
+            xbounds = np.searchsorted(nwavegrid[order_num], lwave_bounds,
+                                      side='right') - 1
+            x_start_all[order_lines] = xbounds[:len(order_lines)]
+            x_end_all[order_lines] = xbounds[len(order_lines):]
         # ---------------------------------------------------------------------
         # debug plot dictionary for plotting later
         if iteration == 0:
-            plot_dict['WAVEGRID'] = nwavegrid
+            plot_dict['WAVEGRID'] = np.array(nwavegrid)
             plot_dict['MODEL'] = model
             plot_dict['PLOT_ORDERS'] = model_plot_orders
             plot_dict['LINE_ORDERS'] = []
@@ -1382,225 +1853,177 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
             # we don't want to continue this run if we have model_velocity
             continue
         # ---------------------------------------------------------------------
-        # loop through all lines
-        for line_it in range(0, len(orders)):
-            # get the order number for this line
-            order_num = orders[line_it]
-            # -----------------------------------------------------------------
-            # if line has been flagged as bad (in all but the first iteration)
-            #   skip this line
-            if (iteration != 1) and not (mask_keep[line_it]):
-                continue
-            # -----------------------------------------------------------------
-            # if this is a new order the get residuals for this order
-            if order_num != current_order:
-                # update current order
-                current_order = int(order_num)
-            # get this orders values
-            ww_ord = nwavegrid[order_num]
-            sci_ord = sci_data[order_num]
-            wave2pix = wave2pixlist[order_num]
-            rms_ord = rms[order_num]
-            model_ord = model[order_num]
-            dmodel_ord = dmodel[order_num]
-            blaze_ord = blaze[order_num]
-            # only do the d2 and d3 stuff if on last iteration
-            if flag_last_iter:
-                d2model_ord = d2model[order_num]
-                d3model_ord = d3model[order_num]
-                # deal with residual projection tables if required
-                if resproj_flag:
-                    # loop around residual project tables
-                    for key in inst.params['RESPROJ_TABLES']:
-                        # add the model for this order
-                        pmodel_ord = proj_model[key]['model'][order_num]
-                        # add to projection_model
-                        proj_model[key]['model_ord'] = pmodel_ord
-            else:
-                d2model_ord = None
-                d3model_ord = None
-            # -----------------------------------------------------------------
-            # get the start and end wavelengths and pixels for this line
-            wave_start = ref_table['WAVE_START'][line_it]
-            wave_end = ref_table['WAVE_END'][line_it]
-            x_start, x_end = wave2pix([wave_start, wave_end])
-            # round pixel positions to nearest pixel
-            x_start, x_end = int(np.floor(x_start)), int(np.floor(x_end))
-            # -----------------------------------------------------------------
-            # boundary conditions
-            if (x_end - x_start) < min_line_width:
-                mask_keep[line_it] = False
-                continue
-            if x_start < 0:
-                mask_keep[line_it] = False
-                continue
-            if x_end > len(ww_ord) - 2:
-                mask_keep[line_it] = False
-                continue
-            # -----------------------------------------------------------------
-            # get weights at the edge of the domain. Pixels inside have a
-            # weight of 1, at the edge, it's proportional to the overlap
-            weight_mask = np.ones(x_end - x_start + 1)
-            # deal with overlapping pixels (before start)
-            if ww_ord[x_start] < wave_start:
-                refdiff = ww_ord[x_start + 1] - wave_start
-                wavediff = ww_ord[x_start + 1] - ww_ord[x_start]
-                weight_mask[0] = 1 - refdiff / wavediff
-            # deal with overlapping pixels (after end)
-            if ww_ord[x_end + 1] > wave_end:
-                refdiff = wave_end - ww_ord[x_end]
-                wavediff = ww_ord[x_end] - ww_ord[x_end - 1]
-                weight_mask[-1] = 1 - (refdiff / wavediff)
-            # get the x pixels
-            xpix = np.arange(x_start, len(weight_mask) + x_start)
-            # get mean xpix and mean blaze for line
-            mean_xpix = mp.nansum(weight_mask * xpix) / mp.nansum(weight_mask)
-            mean_blaze = blaze_ord[(x_start + x_end) // 2]
-            # push mean xpix and mean blaze into ref table
-            ref_table['MEANXPIX'][line_it] = mean_xpix
-            ref_table['MEANBLAZE'][line_it] = mean_blaze
-            # -----------------------------------------------------------------
-            # add to the plots dictionary (for plotting later)
-            if iteration == 1:
-                plot_dict['LINE_ORDERS'] += [order_num]
-                plot_dict['WW_ORD_LINE'] += [ww_ord[x_start:x_end + 1]]
-                plot_dict['SPEC_ORD_LINE'] += [sci_ord[x_start:x_end + 1]]
-                plot_dict['MODEL_ORD_LINE'] += [model_ord[x_start:x_end + 1]]
-            # -----------------------------------------------------------------
-            # derivative of the segment
-            d_seg = dmodel_ord[x_start: x_end + 1] * weight_mask
-
-            # only do the d2 and d3 stuff if on last iteration
-            if flag_last_iter:
-                # keep track of second and third derivatives
-                d2_seg = d2model_ord[x_start: x_end + 1] * weight_mask
-                d3_seg = d3model_ord[x_start: x_end + 1] * weight_mask
-                # deal with residual projection tables if required
-                if resproj_flag:
-                    # loop around residual project tables
-                    for key in inst.params['RESPROJ_TABLES']:
-                        # get model_order projection
-                        pmodel_ord = proj_model[key]['model_ord']
-                        # work out the d_seg for this projection
-                        pd_seg = pmodel_ord[x_start: x_end + 1] * weight_mask
-                        # add to projection_model
-                        proj_model[key]['d_seg'] = pd_seg
-            else:
-                d2_seg, d3_seg = None, None
-            # residual of the segment
-            # TODO -> investigate data type problem
-            # data type should work in the sum below. Does
-            # not happen with SPIRou data
-            sci_seg = sci_ord[x_start:x_end + 1]
-            model_seg = model_ord[x_start:x_end + 1]
-
-            # keep track of the fraction of each lines that is not finite
-            frac_mask = np.isfinite(sci_ord[x_start:x_end + 1])
-            frac_line_valid[line_it] = np.mean(frac_mask)
-
-            # diff_seg = (sci_seg - model_seg) * weight_mask
-            # work out the sum of the weights of the weight mask
-            sum_weight_mask = np.sum(weight_mask)
-
-            # -----------------------------------------------------------------
-            # This is part of the code we had when we had to subtract
-            #   a mean value for each segment as we high-passed
-            #   - no longer used (remove later)
-
-            # denominator = np.nansum(model_seg ** 2 * weight_mask ** 2)
-            # if (sum_weight_mask != 0) and (denominator != 0):
-            #     # subtract off normalized science sum
-            #     # scisum = mp.nansum(sci_seg * weight_mask)
-            #     # sci_seg = sci_seg - (scisum / sum_weight_mask)
-            #     # subtract off normalized model sum
-            #     # modsum = mp.nansum(model_seg * weight_mask)
-            #     #  model_seg = model_seg - (modsum / sum_weight_mask)
-            #     # to be consistent between the spectrum residuals and model
-            #     # d_sum = mp.nansum(d_seg * weight_mask)
-            #
-            #     # TODO --> check if useful at all
-            #     # TODO -> should be an option to subtraction or not the
-            #     # TODO -> mean line flux
-            #     # d_seg = d_seg# - (d_sum / sum_weight_mask)
-            #     # only do the d2 and d3 stuff if on last iteration
-            #     if flag_last_iter:
-            #         # to be consistent between the spectrum residuals and model
-            #         d2_sum = mp.nansum(d2_seg * weight_mask)
-            #         # to be consistent between the spectrum residuals and model
-            #         d3_sum = mp.nansum(d3_seg * weight_mask)
-            #         # deal with residual projection tables if required
-            #         if resproj_flag:
-            #             # loop around residual project tables
-            #             for key in inst.params['RESPROJ_TABLES']:
-            #                 # get the d_seg value
-            #                 d_seg = proj_model[key]['d_seg']
-            #                 # calculate the sum of the d_seg
-            #                 d_sum = mp.nansum(d_seg * weight_mask)
-            #                 # push into the projection model
-            #                 proj_model[key]['d_sum'] = d_sum
-            # -----------------------------------------------------------------
-            # calculate the difference of this segment (weighted by the mask)
-            diff_seg = (sci_seg - model_seg) * weight_mask
-            # work out the sum of the rms
-            sum_rms = np.sum(rms_ord[x_start: x_end + 1] * weight_mask)
-            # work out the mean rms
+        # get the lines to fit in this iteration
+        # ---------------------------------------------------------------------
+        # if line has been flagged as bad (in all but the first iteration)
+        #   skip this line
+        if iteration != 1:
+            fit_lines = np.flatnonzero(mask_keep)
+        else:
+            fit_lines = np.arange(len(orders))
+        # get the start and end pixels for these lines
+        x_starts, x_ends = x_start_all[fit_lines], x_end_all[fit_lines]
+        # boundary conditions
+        bad = (x_ends - x_starts) < min_line_width
+        bad |= x_starts < 0
+        bad |= x_ends > nwavegrid.shape[1] - 2
+        mask_keep[fit_lines[bad]] = False
+        # only keep the lines within the boundary conditions
+        fit_lines = fit_lines[~bad]
+        x_starts, x_ends = x_starts[~bad], x_ends[~bad]
+        nlines = len(fit_lines)
+        # get the order and the start and end wavelengths for these lines
+        line_orders = orders[fit_lines]
+        wave_starts = ref_table['WAVE_START'][fit_lines]
+        wave_ends = ref_table['WAVE_END'][fit_lines]
+        # ---------------------------------------------------------------------
+        # get weights at the edge of the domain. Pixels inside have a
+        # weight of 1, at the edge, it's proportional to the overlap
+        weight_starts = np.ones(nlines)
+        weight_ends = np.ones(nlines)
+        # deal with overlapping pixels (before start)
+        ww_start = nwavegrid[line_orders, x_starts]
+        ww_next = nwavegrid[line_orders, x_starts + 1]
+        over = ww_start < wave_starts
+        refdiff = ww_next[over] - wave_starts[over]
+        wavediff = ww_next[over] - ww_start[over]
+        weight_starts[over] = 1 - refdiff / wavediff
+        # deal with overlapping pixels (after end)
+        ww_end = nwavegrid[line_orders, x_ends]
+        ww_prev = nwavegrid[line_orders, x_ends - 1]
+        over = nwavegrid[line_orders, x_ends + 1] > wave_ends
+        refdiff = wave_ends[over] - ww_end[over]
+        wavediff = ww_end[over] - ww_prev[over]
+        weight_ends[over] = 1 - (refdiff / wavediff)
+        # ---------------------------------------------------------------------
+        # flatten the pixels of all lines (pixel k belongs to line
+        #   line_id[k]) so per-line sums are one np.bincount each
+        npix_line = x_ends - x_starts + 1
+        line_id = np.repeat(np.arange(nlines), npix_line)
+        # the position of the first pixel of each line in the flat arrays
+        first_pix = np.cumsum(npix_line) - npix_line
+        # get the x pixels and orders
+        xpix = x_starts[line_id] + np.arange(len(line_id)) - first_pix[line_id]
+        opix = line_orders[line_id]
+        # the weight of each pixel (the last pixel takes precedence)
+        weight_mask = np.ones(len(line_id))
+        weight_mask[first_pix] = weight_starts
+        weight_mask[first_pix + npix_line - 1] = weight_ends
+        # work out the sum of the weights of the weight mask (all pixels
+        #   have a weight of 1 apart from the edges, so no need to sum them),
+        #   a single pixel line only has the end weight
+        ninner = np.maximum(npix_line - 2, 0)
+        sum_weight_mask = np.where(npix_line > 1, weight_starts, 0.0)
+        sum_weight_mask += ninner + weight_ends
+        # get mean xpix for line (the inner pixels sum to
+        #   ninner * (x_start + x_end) / 2)
+        sum_xpix = np.where(npix_line > 1, weight_starts * x_starts, 0.0)
+        sum_xpix += ninner * (x_starts + x_ends) / 2 + weight_ends * x_ends
+        with warnings.catch_warnings(record=True) as _:
+            mean_xpix = sum_xpix / sum_weight_mask
+        # get mean blaze for line
+        mean_blaze = blaze[line_orders, (x_starts + x_ends) // 2]
+        # push mean xpix and mean blaze into ref table
+        ref_table['MEANXPIX'][fit_lines] = mean_xpix
+        ref_table['MEANBLAZE'][fit_lines] = mean_blaze
+        # ---------------------------------------------------------------------
+        # get the science and model for every line pixel
+        sci_pix = sci_data[opix, xpix]
+        model_pix = model[opix, xpix]
+        # add to the plots dictionary (for plotting later)
+        if iteration == 1 and plot_lines:
+            plot_dict['LINE_ORDERS'] += list(line_orders)
+            plot_dict['WW_ORD_LINE'] += np.split(nwavegrid[opix, xpix],
+                                                 first_pix[1:])
+            plot_dict['SPEC_ORD_LINE'] += np.split(sci_pix, first_pix[1:])
+            plot_dict['MODEL_ORD_LINE'] += np.split(model_pix, first_pix[1:])
+        # keep track of the fraction of each lines that is not finite
+        nfinite = sum_by_line(np.isfinite(sci_pix), line_id, nlines)
+        frac_line_valid[fit_lines] = nfinite / npix_line
+        # the difference between the science and the model (the weights are
+        #   applied per line)
+        np.subtract(sci_data, model, out=diff_2d)
+        # calculate the difference of each segment (weighted by the mask)
+        diff_pix = diff_2d[opix, xpix]
+        diff_pix *= weight_mask
+        # work out the sum of the rms
+        sum_rms = sum_by_line(rms[opix, xpix] * weight_mask, line_id, nlines)
+        # work out the mean rms
+        with warnings.catch_warnings(record=True) as _:
             mean_rms = sum_rms / sum_weight_mask
+        # ---------------------------------------------------------------------
+        # Apply the Bouchy equation to all lines fitted in this iteration
+        # ---------------------------------------------------------------------
+        bargs = [mean_rms, line_orders, x_starts, x_ends, weight_starts,
+                 weight_ends]
+        # work out the 1st derivative
+        #    From bouchy 2001 equation, RV error for each pixel
+        bout = bouchy_equation_lines(dmodel, diff_2d, *bargs)
+        dv[fit_lines], sdv[fit_lines] = bout
+        # only do the d2 and d3 stuff if on last iteration
+        if flag_last_iter:
+            # work out the 2nd derivative
+            #    From bouchy 2001 equation, RV error for each pixel
+            bout = bouchy_equation_lines(d2model, diff_2d, *bargs)
+            d2v[fit_lines], sd2v[fit_lines] = bout
+            # work out the 3rd derivative
+            #    From bouchy 2001 equation, RV error for each pixel
+            bout = bouchy_equation_lines(d3model, diff_2d, *bargs)
+            d3v[fit_lines], sd3v[fit_lines] = bout
+            # deal with residual projection tables if required
+            if resproj_flag:
+                # loop around residual project tables
+                for key in resproj_keys:
+                    # calculate the bouchy equation
+                    pmodel = proj_model[key]['model']
+                    pd_key, psd_key = bouchy_equation_lines(pmodel, diff_2d,
+                                                            *bargs)
+                    # only update if both finite
+                    good = np.isfinite(pd_key) & np.isfinite(psd_key)
+                    proj_model[key]['proj'][fit_lines[good]] = pd_key[good]
+                    proj_model[key]['sproj'][fit_lines[good]] = psd_key[good]
             # -----------------------------------------------------------------
-            # work out the 1st derivative
+            # work out the 0th derivative (the model minus its mean, not
+            #    weighted) - only for lines with at least 2 valid model points
             #    From bouchy 2001 equation, RV error for each pixel
             # -----------------------------------------------------------------
-            bout = bouchy_equation_line(d_seg, diff_seg, mean_rms)
-            dv[line_it], sdv[line_it] = bout
-
-            if flag_last_iter:
-                # to be consistent between the spectrum residuals and model
-                # -------------------------------------------------------------
-                # work out the 0th derivative
-                #    From bouchy 2001 equation, RV error for each pixel
-                # -------------------------------------------------------------
-                if np.sum(np.isfinite(model_seg)) >= 2:
-                    v1 = np.nanmean(model_seg)
-                    bout = bouchy_equation_line(model_seg - v1, diff_seg,
-                                                mean_rms)
-                    d0v[line_it], sd0v[line_it] = bout
-                # -------------------------------------------------------------
-                # work out the 2nd derivative
-                #    From bouchy 2001 equation, RV error for each pixel
-                # -------------------------------------------------------------
-                bout = bouchy_equation_line(d2_seg, diff_seg, mean_rms)
-                d2v[line_it], sd2v[line_it] = bout
-                # -------------------------------------------------------------
-                # work out the 3rd derivative
-                #    From bouchy 2001 equation, RV error for each pixel
-                # -------------------------------------------------------------
-                bout = bouchy_equation_line(d3_seg, diff_seg, mean_rms)
-                d3v[line_it], sd3v[line_it] = bout
-                # deal with residual projection tables if required
-                if resproj_flag:
-                    # loop around residual project tables
-                    for key in inst.params['RESPROJ_TABLES']:
-                        # get d_seg
-                        pd_seg = proj_model[key]['d_seg']
-                        # calculate the bouchy equation
-                        pbout = bouchy_equation_line(pd_seg, diff_seg, mean_rms)
-                        # push into the projection model
-                        pd_key, psd_key = pbout
-                        if np.isfinite(pd_key) and np.isfinite(psd_key):
-                            # only update if both finite
-                            proj_model[key]['proj'][line_it] = pd_key
-                            proj_model[key]['sproj'][line_it] = psd_key
-
-            # only add stuff to the ref_table if on last iteration
-            if flag_last_iter:
-                # -----------------------------------------------------------------
-                # ratio of expected VS actual RMS in difference of model vs line
-                ref_table['RMSRATIO'][line_it] = mp.nanstd(diff_seg) / mean_rms
+            with warnings.catch_warnings(record=True) as _:
+                nmodel = sum_by_line(np.isfinite(model_pix), line_id, nlines)
+                v1 = sum_by_line(model_pix, line_id, nlines, True) / nmodel
+                vector0 = model_pix - v1[line_id]
+                sum_vector2 = sum_by_line(vector0 ** 2, line_id, nlines)
+                sum_diff = sum_by_line(diff_pix * vector0, line_id, nlines)
+                good = nmodel >= 2
+                d0v[fit_lines[good]] = (sum_diff / sum_vector2)[good]
+                sd0_all = mean_rms / np.sqrt(sum_vector2)
+                sd0v[fit_lines[good]] = sd0_all[good]
+            # -----------------------------------------------------------------
+            # ratio of expected VS actual RMS in difference of model vs line
+            #   (the nanstd of each diff segment)
+            with warnings.catch_warnings(record=True) as _:
+                valid_diff = np.isfinite(diff_pix)
+                ndiff = sum_by_line(valid_diff, line_id, nlines)
+                # NaN pixels contribute nothing to the sums (as a nansum) -
+                #   zero them once and reuse for the mean and the chi2
+                diff_pix0 = np.where(np.isnan(diff_pix), 0.0, diff_pix)
+                mean_diff = sum_by_line(diff_pix0, line_id, nlines) / ndiff
+                var_pix = (diff_pix - mean_diff[line_id]) ** 2
+                var_diff = sum_by_line(var_pix, line_id, nlines, True) / ndiff
+                rmsratio = np.sqrt(var_diff) / mean_rms
+                ref_table['RMSRATIO'][fit_lines] = rmsratio
                 # effective number of pixels in line
-                ref_table['NPIXLINE'][line_it] = len(diff_seg)
-                # Considering the number of pixels, expected and actual RMS, this
-                #   is the likelihood that the line is actually valid from chi2
-                #   point of view
-                ref_table['CHI2'][line_it] = mp.nansum((diff_seg / mean_rms) ** 2)
+                ref_table['NPIXLINE'][fit_lines] = npix_line
+                # Considering the number of pixels, expected and actual RMS,
+                #   this is the likelihood that the line is actually valid
+                #   from chi2 point of view
+                #   (mean_rms is constant over a line so divide the sum of
+                #   the squared diff once per line)
+                chi2 = sum_by_line(diff_pix0 ** 2, line_id, nlines)
+                chi2 /= mean_rms ** 2
+                # as a nansum over the pixels: a NaN mean rms (or a zero mean
+                #   rms with a zero diff, 0/0) makes every pixel NaN (sum = 0)
+                chi2[np.isnan(chi2)] = 0.0
+                ref_table['CHI2'][fit_lines] = chi2
         # ---------------------------------------------------------------------
         # get the best etimate of the velocity and update sline
         rv_mean, bulk_error = mp.odd_ratio_mean(dv, sdv)
@@ -1612,9 +2035,8 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
         # ... no, not that smart after all
         # rv_mean = erfinv(rv_mean / 2250) * 2500
         nsig = (dv - rv_mean) / sdv
-        # remove nans
-        nsig = nsig[np.isfinite(nsig)]
-        # remove sigma outliers
+        # remove nans and sigma outliers in one pass (NaN and inf values
+        #   always fail the comparison)
         nsig = nsig[np.abs(nsig) < nsig_threshold]
         # get the sigma of nsig
         stddev_nsig = mp.estimate_sigma(nsig)
@@ -1623,8 +2045,9 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
         margs = [stddev_nsig]
         log.general(msg.format(*margs))
         # ---------------------------------------------------------------------
-        # get final rv value
-        rv_final = np.array(dv + sys_rv - berv)
+        # get final rv value (in place, rv_final is allocated once)
+        np.add(dv, sys_rv, out=rv_final)
+        np.subtract(rv_final, berv, out=rv_final)
         # add mean rv to sys_rv
         sys_rv = sys_rv + rv_mean
         # get end time
@@ -1670,15 +2093,19 @@ def compute_rv(inst: InstrumentsType, sci_iteration: int,
     # adding to the fits table the 3rd derivative projection
     ref_table['d3v'] = d3v
     ref_table['sd3v'] = sd3v
-    # calculate the chi2 cdf
-    chi2_cdf = 1 - stats.chi2.cdf(ref_table['CHI2'], ref_table['NPIXLINE'])
+    # calculate the chi2 cdf (the chi2 survival function, 1 - cdf, as the
+    #   regularized upper incomplete gamma function in one vectorized call),
+    #   lines without pixels have no valid degrees of freedom (NaN)
+    npixline = np.asarray(ref_table['NPIXLINE'], dtype=float)
+    npixline[npixline <= 0] = np.nan
+    chi2_cdf = gammaincc(npixline / 2.0, np.asarray(ref_table['CHI2']) / 2.0)
     ref_table['CHI2_VALID_CDF'] = chi2_cdf
     # fraction of each lines that is a valid pixel when computing the dv
     ref_table['FRAC_LINE_VALID'] = frac_line_valid
     # deal with residual projection tables if required
     if resproj_flag:
         # loop around residual project tables
-        for key in inst.params['RESPROJ_TABLES']:
+        for key in resproj_keys:
             # add to the reference table
             ref_table[key] = proj_model[key]['proj']
             ref_table['s' + key] = proj_model[key]['sproj']
@@ -1759,6 +2186,34 @@ def smart_timing(durations: List[float], left: int) -> Tuple[float, float, str]:
 # =============================================================================
 # Define compil functions
 # =============================================================================
+def load_lblrv_files(inst: InstrumentsType, lblrvfiles: np.ndarray
+                     ) -> Iterator[Tuple[Table, io.LBLHeader]]:
+    """
+    Load the LBL RV files one at a time (in order). If NUM_WORKERS > 1 the
+    files are read in a pool of worker processes ahead of being used.
+
+    :param inst: Instrument instance
+    :param lblrvfiles: np.ndarray, array of strings, the absolute path to each
+                       LBL RV file
+
+    :return: generator, the LBL RV table and header for each file
+    """
+    # get the number of workers
+    num_workers = inst.params['NUM_WORKERS']
+    # deal with no multiprocessing
+    if num_workers < 2:
+        for lblrvfile in lblrvfiles:
+            yield inst.load_lblrv_file(lblrvfile)
+        return
+    # send the files to each worker in chunks (imap keeps the order)
+    chunksize = max(1, len(lblrvfiles) // (4 * num_workers))
+    # read the files over a pool of workers (any exception in a worker is
+    #   re-raised here by imap)
+    with multiprocessing.Pool(num_workers) as pool:
+        for lblrv in pool.imap(inst.load_lblrv_file, lblrvfiles, chunksize):
+            yield lblrv
+
+
 def make_rdb_table(inst: InstrumentsType, rdbfile: str,
                    lblrvfiles: np.ndarray, plot_dir: str) -> Dict[str, Any]:
     """
@@ -1875,6 +2330,9 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
     npixline0 = np.array(rvtable0['NPIXLINE'])
     # flag a calibration file
     flag_calib = inst.params['DATA_TYPE'] != 'SCIENCE'
+    # flag whether we need the cumulative plot values (the probability
+    #   density function and its gaussian fit are only used for this plot)
+    flag_cumul = inst.params['PLOT'] and inst.params['PLOT_COMPIL_CUMUL']
     # do not consider lines below wave_min limit
     good = wavestart0 > wave_min
     # do not consider lines above wave_max limit
@@ -1895,6 +2353,11 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
     d2v_arr, sd2v_arr = np.zeros([nby, nbx]), np.zeros([nby, nbx])
     d3v_arr, sd3v_arr = np.zeros([nby, nbx]), np.zeros([nby, nbx])
     contrast_arr, scontrast_arr = np.zeros([nby, nbx]), np.zeros([nby, nbx])
+    # calibrations keep the rv and dvrms of each file (used again for the
+    #   chromatic slope)
+    if flag_calib:
+        cal_dv_arr = np.zeros([nby, nbx])
+        cal_sdv_arr = np.zeros([nby, nbx])
 
     # projection model for the rdb_dict
     proj_model = dict()
@@ -1925,160 +2388,174 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
     log.info('Producing LBL RDB 1 table')
     # store any missing keys
     missing_keys = dict()
-    # loop around lbl rv files
-    for row in tqdm(range(len(lblrvfiles))):
-        # ---------------------------------------------------------------------
-        # get lbl rv file table and header
-        # ---------------------------------------------------------------------
-        # load table and header
-        rvtable, rvhdr = inst.load_lblrv_file(lblrvfiles[row])
-        # store the berv value for each file
-        berv[row] = inst.get_berv(rvhdr)
-        # fix header (instrument specific)
-        rvhdr = inst.fix_lblrv_header(rvhdr)
-        # fill rjd value
-        rdb_dict['rjd'][row] = inst.get_rjd_value(rvhdr)
-        # fill in plot date
-        rdb_dict['plot_date'][row] = inst.get_plot_date(rvhdr)
-        # ---------------------------------------------------------------------
-        # fill in filename
-        # ---------------------------------------------------------------------
-        rdb_dict['FILENAME'][row] = os.path.basename(lblrvfiles[row])
-        rdb_dict['LBL_SCI_DIR'][row] = os.path.dirname(lblrvfiles[row])
-        # ---------------------------------------------------------------------
-        # fill in header keys
-        # ---------------------------------------------------------------------
-        # loop around header keys
-        for ikey, key in enumerate(header_keys):
-            # deal with FP flags
-            if flag_calib and fp_flags[ikey]:
-                rdb_dict[key][row] = np.nan
-            # if we have key add the value
-            elif key in rvhdr:
-                rdb_dict[key][row] = rvhdr.get_hkey(key)
-            # else print a warning and add a NaN
-            else:
-                # add to missing keys dict counter
-                if key in missing_keys:
-                    missing_keys[key] += 1
+    # load lbl rv files (in parallel if NUM_WORKERS > 1)
+    #   (closing the iterator on leaving the block also closes any worker
+    #   processes, even on an exception)
+    lblrv_iterator = load_lblrv_files(inst, lblrvfiles)
+    with contextlib.closing(lblrv_iterator):
+        # loop around lbl rv files
+        for row in tqdm(range(len(lblrvfiles))):
+            # -----------------------------------------------------------------
+            # get lbl rv file table and header
+            # -----------------------------------------------------------------
+            # load table and header
+            rvtable, rvhdr = next(lblrv_iterator)
+            # store the berv value for each file
+            berv[row] = inst.get_berv(rvhdr)
+            # fix header (instrument specific)
+            rvhdr = inst.fix_lblrv_header(rvhdr)
+            # fill rjd value
+            rdb_dict['rjd'][row] = inst.get_rjd_value(rvhdr)
+            # fill in plot date
+            rdb_dict['plot_date'][row] = inst.get_plot_date(rvhdr)
+            # -----------------------------------------------------------------
+            # fill in filename
+            # -----------------------------------------------------------------
+            rdb_dict['FILENAME'][row] = os.path.basename(lblrvfiles[row])
+            rdb_dict['LBL_SCI_DIR'][row] = os.path.dirname(lblrvfiles[row])
+            # -----------------------------------------------------------------
+            # fill in header keys
+            # -----------------------------------------------------------------
+            # loop around header keys
+            for ikey, key in enumerate(header_keys):
+                # deal with FP flags
+                if flag_calib and fp_flags[ikey]:
+                    rdb_dict[key][row] = np.nan
+                # if we have key add the value
+                elif key in rvhdr:
+                    rdb_dict[key][row] = rvhdr.get_hkey(key)
+                # else print a warning and add a NaN
                 else:
-                    missing_keys[key] = 1
-                # set value to NaN
-                rdb_dict[key][row] = np.nan
-        # ---------------------------------------------------------------------
-        # Read all lines for this file and load into arrays
-        # ---------------------------------------------------------------------
-        # if we don't have a calibration we set the rvs and dvrms from rv table
-        if not flag_calib:
-            dv_arr[row] = rvtable[good]['dv']
-            sdv_arr[row] = rvtable[good]['sdv']
-        # else we calculate it using odd ratio mean
-        else:
-            cal_rv = np.array(rvtable[good]['dv'], dtype=float)
-            cal_dvrms = np.array(rvtable[good]['sdv'], dtype=float)
-            # estimate using odd ratio mean
-            cal_guess, cal_bulk_error = mp.odd_ratio_mean(cal_rv, cal_dvrms)
+                    # add to missing keys dict counter
+                    if key in missing_keys:
+                        missing_keys[key] += 1
+                    else:
+                        missing_keys[key] = 1
+                    # set value to NaN
+                    rdb_dict[key][row] = np.nan
+            # -----------------------------------------------------------------
+            # Read all lines for this file and load into arrays
+            # -----------------------------------------------------------------
+            # note we take the column before applying the good mask (masking
+            #   the table would copy every column for each value we need)
+            # if we don't have a calibration we set the rvs and dvrms from the
+            #   rv table
+            if not flag_calib:
+                dv_arr[row] = rvtable['dv'][good]
+                sdv_arr[row] = rvtable['sdv'][good]
+            # else we calculate it using odd ratio mean
+            else:
+                cal_rv = np.array(rvtable['dv'][good], dtype=float)
+                cal_dvrms = np.array(rvtable['sdv'][good], dtype=float)
+                # keep these for the chromatic slope (so we do not have to load
+                #   the lbl rv files again)
+                cal_dv_arr[row], cal_sdv_arr[row] = cal_rv, cal_dvrms
+                # estimate using odd ratio mean
+                cal_guess, cal_bulk_error = mp.odd_ratio_mean(cal_rv,
+                                                              cal_dvrms)
+                # push into rdb_dict
+                rdb_dict['vrad'][row] = cal_guess
+                rdb_dict['svrad'][row] = cal_bulk_error
+            # deal with residual projection tables
+            if resproj_flag:
+                # loop around keys in residual projection tables
+                for key in inst.params['RESPROJ_TABLES']:
+                    # check that key is in rvtable
+                    if key not in rvtable.colnames:
+                        # log an error
+                        emsg = ('RESPROJ Table key "{0}" not in rvtable.'
+                                'Please do not populat the RESPROJ_TABLES '
+                                'with key {0}')
+                        raise LblException(emsg.format(key))
+                    # copy the rvtable array for this residual projection
+                    arr = np.array(rvtable[key][good], dtype=float)
+                    # copy the rvtable error array for this residual projection
+                    sarr = np.array(rvtable['s' + key][good], dtype=float)
+                    # get the guess and bulk error
+                    val_guess, val_bulk_error = mp.odd_ratio_mean(arr, sarr)
+                    # push into the rdb dictioanry
+                    rdb_dict[key][row] = val_guess
+                    rdb_dict['s' + key][row] = val_bulk_error
+            # get the d2v, sd2v, d3v and sd3v values from table
+            wave_vec = np.array(rvtable['WAVE_START'][good], dtype=float)
+            contrast = np.array(rvtable['contrast'][good], dtype=float)
+            scontrast = np.array(rvtable['sig_contrast'][good], dtype=float)
+            d2v = np.array(rvtable['d2v'][good], dtype=float)
+            sd2v = np.array(rvtable['sd2v'][good], dtype=float)
+            d3v = np.array(rvtable['d3v'][good], dtype=float)
+            sd3v = np.array(rvtable['sd3v'][good], dtype=float)
+            # push these values into array (for saving images later)
+            wave_arr[row] = wave_vec
+            d2v_arr[row], sd2v_arr[row] = d2v, sd2v
+            d3v_arr[row], sd3v_arr[row] = d3v, sd3v
+            contrast_arr[row], scontrast_arr[row] = contrast, scontrast
+            # use the odd mean ratio to calculate d2v and sd2v
+            contrast_guess, contrast_bulk_error = mp.odd_ratio_mean(contrast,
+                                                                    scontrast)
             # push into rdb_dict
-            rdb_dict['vrad'][row] = cal_guess
-            rdb_dict['svrad'][row] = cal_bulk_error
-        # deal with residual projection tables
-        if resproj_flag:
-            # loop around keys in residual projection tables
-            for key in inst.params['RESPROJ_TABLES']:
-                # check that key is in rvtable
-                if key not in rvtable.colnames:
-                    # log an error
-                    emsg = ('RESPROJ Table key "{0}" not in rvtable.'
-                            'Please do not populat the RESPROJ_TABLES with '
-                            'key {0}')
-                    raise LblException(emsg.format(key))
-                # copy the rvtable array for this residual projection
-                arr = np.array(rvtable[good][key], dtype=float)
-                # copy the rvtable error array for this residual projection
-                sarr = np.array(rvtable[good]['s' + key], dtype=float)
-                # get the guess and bulk error
-                val_guess, val_bulk_error = mp.odd_ratio_mean(arr, sarr)
-                # push into the rdb dictioanry
-                rdb_dict[key][row] = val_guess
-                rdb_dict['s' + key][row] = val_bulk_error
-        # get the d2v, sd2v, d3v and sd3v values from table
-        wave_vec = np.array(rvtable[good]['WAVE_START'], dtype=float)
-        contrast = np.array(rvtable[good]['contrast'], dtype=float)
-        scontrast = np.array(rvtable[good]['sig_contrast'], dtype=float)
-        d2v = np.array(rvtable[good]['d2v'], dtype=float)
-        sd2v = np.array(rvtable[good]['sd2v'], dtype=float)
-        d3v = np.array(rvtable[good]['d3v'], dtype=float)
-        sd3v = np.array(rvtable[good]['sd3v'], dtype=float)
-        # push these values into array (for saving images later)
-        wave_arr[row] = wave_vec
-        d2v_arr[row], sd2v_arr[row] = d2v, sd2v
-        d3v_arr[row], sd3v_arr[row] = d3v, sd3v
-        contrast_arr[row], scontrast_arr[row] = contrast, scontrast
-        # use the odd mean ratio to calculate d2v and sd2v
-        contrast_guess, contrast_bulk_error = mp.odd_ratio_mean(contrast,
-                                                                scontrast)
-        # push into rdb_dict
-        rdb_dict['contrast'][row] = contrast_guess
-        rdb_dict['sig_contrast'][row] = contrast_bulk_error
-
-        # use the odd mean ratio to calculate d2v and sd2v
-        d2v_guess, d2v_bulk_error = mp.odd_ratio_mean(d2v, sd2v)
-        # push into rdb_dict
-        rdb_dict['d2v'][row] = d2v_guess
-        rdb_dict['sd2v'][row] = d2v_bulk_error
-        # use the odd mean ratio to calculate d3v and sd3v
-        d3v_guess, d3v_bulk_error = mp.odd_ratio_mean(d3v, sd3v)
-        # push into rdb_dict
-        rdb_dict['d3v'][row] = d3v_guess
-        rdb_dict['sd3v'][row] = d3v_bulk_error
-        # ---------------------------------------------------------------------
-        # if we don't have a calibration add plot values
-        if not flag_calib:
-            # plot specific math
-            xlim = [med_velo - 5000, med_velo + 5000]
-            # get velocity range
-            vrange = np.arange(xlim[0], xlim[1], 50.0)
-            # storage for probability density function
-            pdf = np.zeros_like(vrange, dtype=float)
-            # mask the rv and dvrms by best_mask
-            best_rv = dv_arr[row][best_mask]
-            best_dvrms = sdv_arr[row][best_mask]
-            # track finite values
-            finite_mask = np.isfinite(best_rv) & np.isfinite(best_dvrms)
-            # loop around each line
-            for line_it in range(len(best_rv)):
-                # only deal with finite masks
-                if finite_mask[line_it]:
-                    # get exponent
-                    part = (vrange - best_rv[line_it]) / best_dvrms[line_it]
-                    # calculate pdf weights
-                    pdf_weight = np.exp(-0.5 * part ** 2)
-                    pdf_weight = pdf_weight / best_dvrms[line_it]
-                    # add to pdf for each vrange
-                    pdf = pdf + pdf_weight
-            # fit the probability density function
-            guess = [med_velo, 500.0, np.max(pdf), 0.0, 0.0]
-            # set specific func name for curve fit errors
-            sfuncname = '{0}.RDB1-ROW[{1}]'.format(func_name, row)
-            # try to compute curve fit
-            try:
-                pdf_coeffs, _ = mp.curve_fit(mp.gauss_fit_s, vrange, pdf,
-                                             p0=guess, funcname=sfuncname)
-                # fit pdf function
-                pdf_fit = mp.gauss_fit_s(vrange, *pdf_coeffs)
-            except base_classes.LblCurveFitException as e:
-                wmsg = 'CurveFit exception - skipping file'
-                wmsg += '\n\tFile = {0}'.format(lblrvfiles[row])
-                wmsg += '\n\tP0 = {0}'.format(e.p0)
-                wmsg += '\n\tFunction = {0}'.format(e.func)
-                wmsg += '\n\tError: {0}'.format(e.error)
-                log.warning(wmsg)
-                # do not add this file
-                continue
-            # append values to plot lists
-            vrange_all.append(vrange)
-            pdf_all.append(pdf)
-            pdf_fit_all.append(pdf_fit)
+            rdb_dict['contrast'][row] = contrast_guess
+            rdb_dict['sig_contrast'][row] = contrast_bulk_error
+
+            # use the odd mean ratio to calculate d2v and sd2v
+            d2v_guess, d2v_bulk_error = mp.odd_ratio_mean(d2v, sd2v)
+            # push into rdb_dict
+            rdb_dict['d2v'][row] = d2v_guess
+            rdb_dict['sd2v'][row] = d2v_bulk_error
+            # use the odd mean ratio to calculate d3v and sd3v
+            d3v_guess, d3v_bulk_error = mp.odd_ratio_mean(d3v, sd3v)
+            # push into rdb_dict
+            rdb_dict['d3v'][row] = d3v_guess
+            rdb_dict['sd3v'][row] = d3v_bulk_error
+            # -----------------------------------------------------------------
+            # if we don't have a calibration add plot values (only if we are
+            #   plotting - otherwise we skip the gaussian fit for each file)
+            if not flag_calib and flag_cumul:
+                # plot specific math
+                xlim = [med_velo - 5000, med_velo + 5000]
+                # get velocity range
+                vrange = np.arange(xlim[0], xlim[1], 50.0)
+                # storage for probability density function
+                pdf = np.zeros_like(vrange, dtype=float)
+                # mask the rv and dvrms by best_mask
+                best_rv = dv_arr[row][best_mask]
+                best_dvrms = sdv_arr[row][best_mask]
+                # track finite values
+                finite_mask = np.isfinite(best_rv) & np.isfinite(best_dvrms)
+                # loop around each line
+                for line_it in range(len(best_rv)):
+                    # only deal with finite masks
+                    if finite_mask[line_it]:
+                        # get exponent
+                        part = vrange - best_rv[line_it]
+                        part = part / best_dvrms[line_it]
+                        # calculate pdf weights
+                        pdf_weight = np.exp(-0.5 * part ** 2)
+                        pdf_weight = pdf_weight / best_dvrms[line_it]
+                        # add to pdf for each vrange
+                        pdf = pdf + pdf_weight
+                # fit the probability density function
+                guess = [med_velo, 500.0, np.max(pdf), 0.0, 0.0]
+                # set specific func name for curve fit errors
+                sfuncname = '{0}.RDB1-ROW[{1}]'.format(func_name, row)
+                # try to compute curve fit
+                try:
+                    pdf_coeffs, _ = mp.curve_fit(mp.gauss_fit_s, vrange, pdf,
+                                                 p0=guess, funcname=sfuncname)
+                    # fit pdf function
+                    pdf_fit = mp.gauss_fit_s(vrange, *pdf_coeffs)
+                except base_classes.LblCurveFitException as e:
+                    wmsg = 'CurveFit exception - skipping file'
+                    wmsg += '\n\tFile = {0}'.format(lblrvfiles[row])
+                    wmsg += '\n\tP0 = {0}'.format(e.p0)
+                    wmsg += '\n\tFunction = {0}'.format(e.func)
+                    wmsg += '\n\tError: {0}'.format(e.error)
+                    log.warning(wmsg)
+                    # do not add this file
+                    continue
+                # append values to plot lists
+                vrange_all.append(vrange)
+                pdf_all.append(pdf)
+                pdf_fit_all.append(pdf_fit)
     # -------------------------------------------------------------------------
     # display missing keys
     if len(missing_keys) > 0:
@@ -2184,7 +2661,7 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
             # and can be used to flag lines that suspiciously correlate
             # with BERV.
             with warnings.catch_warnings(record=True) as _:
-                pout = pearsonr(berv[good], per_line_diff[good])
+                pout = mp.pearsonr(berv[good], per_line_diff[good])
             prob_pearsonr[line_it] = pout[1]
 
             if prob_pearsonr[line_it] < cut_pearsonr:
@@ -2239,17 +2716,19 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
     log.info('Computing chromatic slope and per-bandpass statistics')
     # zero filled array
     lblrv_zeros = np.zeros_like(lblrvfiles, dtype=float)
+    # get the line columns of rvtable0 once (same for all rvtables)
+    wave_start_arr = np.array(rvtable0['WAVE_START'], dtype=float)
+    xpix_arr = np.array(rvtable0['XPIX'], dtype=float)
     # ---------------------------------------------------------------------
     # Update table with vrad/svrad, per epoch values and fwhm/sig_fwhm
     # ---------------------------------------------------------------------
     for row in tqdm(range(len(lblrvfiles))):
-        # if we have a calibration load the lbl rv file
+        # if we have a calibration use the rvs kept from the lbl rv file
         if flag_calib:
-            rvtable, rvhdr = inst.load_lblrv_file(lblrvfiles[row])
-            rvtable = rvtable[ref_good_pix]  # to match dvarr size
-            residuals = np.array(rvtable['dv'])
+            # copy as these are modified below
+            residuals = np.array(cal_dv_arr[row])
             # get the error
-            err = np.array(rvtable['sdv'])
+            err = np.array(cal_sdv_arr[row])
             rvs_row = residuals
         else:
             # get the residuals of the rvs to the rv per line model
@@ -2288,7 +2767,7 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
             good &= (nsig < 10)
             good &= (err < 100 * np.nanmedian(err))
             # get valid wave and subtract reference wavelength
-            valid_wave = rvtable0['WAVE_START'][good] - reference_wavelength
+            valid_wave = wave_start_arr[good] - reference_wavelength
             # get valid rv an dv drms
             valid_rv = (rvs_row - rv_per_line_model[0])[good]
             valid_dvrms = err[good]
@@ -2427,8 +2906,8 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
         for iband in range(len(bands)):
             # make a mask based on the band (can use rvtable0 as wave start
             #   is the same for all rvtables)
-            band_mask = rvtable0['WAVE_START'] > blue_end[iband]
-            band_mask &= rvtable0['WAVE_START'] < red_end[iband]
+            band_mask = wave_start_arr > blue_end[iband]
+            band_mask &= wave_start_arr < red_end[iband]
             # decide whether to use regions
             if use_regions[iband]:
                 band_regions = list(region_names)
@@ -2442,8 +2921,8 @@ def make_rdb_table(inst: InstrumentsType, rdbfile: str,
             # loop around the regions
             for iregion in range(len(band_regions)):
                 # mask based on region
-                region_mask = rvtable0['XPIX'] > band_region_low[iregion]
-                region_mask &= rvtable0['XPIX'] < band_region_high[iregion]
+                region_mask = xpix_arr > band_region_low[iregion]
+                region_mask &= xpix_arr < band_region_high[iregion]
                 # -------------------------------------------------------------
                 # get combined mask for band and region
                 comb_mask = band_mask & region_mask
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of writing and loading tables (lbl.core.io) in the supported formats
+
+Run with pytest (pip install lbl[test])
+"""
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from lbl.core import base_classes
+from lbl.core import io
+
+
+# =============================================================================
+# Define functions
+# =============================================================================
+def _table() -> Table:
+    """
+    Make a small table with integer and float columns
+    """
+    table = Table()
+    table['ORDER'] = np.arange(5)
+    table['WAVE_START'] = np.linspace(500, 510, 5)
+    return table
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'fits', 'hdf5'])
+def test_write_load_table(tmp_path, fmt):
+    if fmt == 'hdf5':
+        pytest.importorskip('h5py')
+    table = _table()
+    filename = str(tmp_path / 'table.{0}'.format(fmt))
+    io.write_table(filename, table, fmt=fmt)
+    table2 = io.load_table(filename, kind='test table', fmt=fmt)
+    assert table2.colnames == table.colnames
+    for col in table.colnames:
+        np.testing.assert_array_equal(table2[col], table[col])
+
+
+def test_hdf5_table_without_h5py(tmp_path, monkeypatch):
+    monkeypatch.setattr(io, 'HAS_H5PY', False)
+    filename = str(tmp_path / 'table.h5')
+    with pytest.raises(base_classes.LblException):
+        io.write_table(filename, _table(), fmt='hdf5')
+    with pytest.raises(base_classes.LblException):
+        io.load_table(filename, kind='test table', fmt='hdf5')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the reference table columns read back from FITS (big-endian) being
+passed to the compiled line functions of compute_rv
+
+Run with pytest (pip install lbl[test])
+"""
+import numpy as np
+from astropy.table import Table
+
+from lbl.core import io
+from lbl.science import general
+
+
+# =============================================================================
+# Define functions
+# =============================================================================
+def _line_table(nlines: int = 20, norders: int = 3, npix: int = 200):
+    """
+    Make a set of lines (order, start/end pixel and edge weights) and a 2D
+    vector / diff vector to apply the Bouchy equation to
+    """
+    rng = np.random.default_rng(1)
+    table = Table()
+    table['ORDER'] = rng.integers(0, norders, nlines)
+    table['X_START'] = rng.integers(1, npix - 20, nlines)
+    table['X_END'] = table['X_START'] + rng.integers(2, 15, nlines)
+    table['WEIGHT_START'] = rng.uniform(0, 1, nlines)
+    table['WEIGHT_END'] = rng.uniform(0, 1, nlines)
+    table['MEAN_RMS'] = rng.uniform(1, 2, nlines)
+    vector = rng.normal(0, 1, (norders, npix))
+    diff = rng.normal(0, 1, (norders, npix))
+    return table, vector, diff
+
+
+def _bouchy(table: Table, vector: np.ndarray, diff: np.ndarray):
+    """
+    Apply the Bouchy equation to the lines of a table
+    """
+    return general.bouchy_equation_lines(vector, diff,
+                                         np.asarray(table['MEAN_RMS']),
+                                         np.asarray(table['ORDER']),
+                                         np.asarray(table['X_START']),
+                                         np.asarray(table['X_END']),
+                                         np.asarray(table['WEIGHT_START']),
+                                         np.asarray(table['WEIGHT_END']))
+
+
+def test_bouchy_equation_lines_fits_columns(tmp_path):
+    table, vector, diff = _line_table()
+    # write and read back the lines as a fits table
+    filename = str(tmp_path / 'lines.fits')
+    io.write_table(filename, table, fmt='fits')
+    fits_table = io.load_table(filename, kind='test table', fmt='fits')
+    # fits columns are big-endian
+    assert not np.asarray(fits_table['ORDER']).dtype.isnative
+    # the same values as for the native table
+    values, rms_values = _bouchy(fits_table, vector, diff)
+    values0, rms_values0 = _bouchy(table, vector, diff)
+    np.testing.assert_array_equal(values, values0)
+    np.testing.assert_array_equal(rms_values, rms_values0)
+    assert np.all(np.isfinite(values))
+
+
+class _FitsInstrument:
+    """
+    The parts of an instrument used by make_ref_dict to read a ref table
+    """
+    params = dict(REF_TABLE_FMT='fits')
+
+    def load_mask(self, mask_file: str):
+        return None
+
+
+def test_make_ref_dict_fits_native(tmp_path):
+    nlines = 10
+    # a ref table with all the columns of make_ref_dict
+    table = Table()
+    table['ORDER'] = np.arange(nlines)
+    for col in ['WAVE_START', 'WAVE_END', 'WEIGHT_LINE', 'XPIX', 'LINE_SNR',
+                'LINE_DEPTH', 'LOCAL_FLUX', 'RMSRATIO', 'MEANXPIX',
+                'MEANBLAZE', 'AMP_CONTINUUM', 'CHI2', 'CHI2_VALID_CDF']:
+        table[col] = np.linspace(1, 2, nlines)
+    table['NPIXLINE'] = np.arange(nlines)
+    filename = str(tmp_path / 'ref_table.fits')
+    io.write_table(filename, table, fmt='fits')
+    # read the ref table back
+    ref_dict = general.make_ref_dict(_FitsInstrument(), filename, True,
+                                     [], 'mask', 'calib')
+    # every column must be a native, contiguous array
+    for col in table.colnames:
+        assert ref_dict[col].dtype.isnative
+        assert ref_dict[col].flags['C_CONTIGUOUS']
+        np.testing.assert_array_equal(ref_dict[col], table[col])
+    # the ORDER column can be passed straight to the compiled functions
+    assert ref_dict['ORDER'].dtype == int